@@ -1,33 +1,63 @@
 import mergevcf.mergedfile as mergedfile
+import mergevcf.jobs as jobs
+import mergevcf.memory as memory
 import argparse
-import os
+import json
 import sys
 
 def main():
     """Merge VCF files, output to stdout or file"""
-    defsvwindow = 100
+    if len(sys.argv) > 1 and sys.argv[1] in ['serve', 'submit']:
+        import mergevcf.server as server
+        if sys.argv[1] == 'serve':
+            return server.serveMain(sys.argv[2:])
+        return server.submitMain(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'concordance':
+        import mergevcf.windowjoin as windowjoin
+        return windowjoin.concordanceMain(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'cohort':
+        import mergevcf.cohort as cohort
+        return cohort.cohortMain(sys.argv[2:])
 
-    parser = argparse.ArgumentParser(description='Merge calls in VCF files')
-    parser.add_argument('input_files', nargs='+', help='Input VCF files')
-    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Specify output file (default:stdout)") 
-    parser.add_argument('-v', '--verbose', action='store_true', help="Specify verbose output")
-    parser.add_argument('-l', '--labels', type=str, help='Comma-separated labels for each input VCF file (default:basenames)')
-    parser.add_argument('-n', '--ncallers', action='store_true', help='Annotate variant with number of callers')
-    parser.add_argument('-m', '--mincallers', type=int, default=0, help='Minimum # of callers for variant to pass')
-    parser.add_argument('-s', '--sv', action='store_true', help='Force interpretation as SV (default:false)')
-    parser.add_argument('-f', '--filtered', action='store_true', help='Include records that have failed one or more filters (default:false)')
-    parser.add_argument('-w', '--svwindow', default=defsvwindow, type=int,
-                         help='Window for comparing breakpoint positions for SVs (default:'+str(defsvwindow)+')')
+    parser = argparse.ArgumentParser(description='Merge calls in VCF files',
+                                     epilog='Use "mergevcf serve" to run a persistent merge server, '
+                                            '"mergevcf submit" to submit merges to it, '
+                                            '"mergevcf concordance" to compare SV callsets, and '
+                                            '"mergevcf cohort" to catalogue sites across samples')
+    jobs.addMergeArguments(parser, manifest=True)
 
     args = parser.parse_args()
+    if args.manifest is not None:
+        if len(args.input_files) > 0:
+            parser.error("Input files can't be given with --manifest")
+        if args.checkpoint is not None:
+            parser.error("--checkpoint can't be used with --manifest, which skips completed merges")
+        return manifestMain(args)
+    if len(args.input_files) == 0:
+        parser.error("No input files given")
+    if args.sorted and (args.max_memory is not None or args.checkpoint is not None or args.parse_jobs > 1):
+        parser.error("--sorted can't be used with --max-memory, --checkpoint or --parse-jobs")
+
     input_files = args.input_files
-    if args.labels is None:
-        labels = [os.path.splitext(os.path.basename(f))[0] for f in input_files]
-    else:
-        labels = [label.strip() for label in args.labels.split(',')]
+    labels = jobs.labelsFromArgs(args)
+
+    stats = jobs.mergeWithOptions(input_files, labels, args.output, jobs.optionsFromArgs(args))
+    if args.stats is not None:
+        with open(args.stats, 'w') as statsfile:
+            json.dump(stats, statsfile, indent=2)
+
+def manifestMain(args):
+    """Run all of the merges in a manifest, writing a summary report"""
+    maxmemory = None
+    if args.sample_max_memory is not None:
+        maxmemory = memory.parseMemorySize(args.sample_max_memory)
+    with open(args.manifest, 'r') as manifestfile:
+        joblist = jobs.readManifest(manifestfile)
 
-    mergedfile.merge(input_files, labels, args.sv, args.output,
-                     slop=args.svwindow, verbose=args.verbose,
-                     output_ncallers=args.ncallers,
-                     min_num_callers=args.mincallers,
-                     filterByChromosome=True, noFilter=args.filtered)
+    results = jobs.runManifest(joblist, jobs.optionsFromArgs(args), args.jobs, maxmemory)
+    jobs.writeSummary(results, args.output)
+    if args.stats is not None:
+        with open(args.stats, 'w') as statsfile:
+            json.dump(results, statsfile, indent=2)
+    if any(result['status'] == 'failed' for result in results):
+        sys.exit(1)
@@ -0,0 +1,37 @@
+"""
+Checkpoints of a merge's ingestion, so that an interrupted merge can resume
+where it left off: the input being read, the byte offset and line number
+reached in it, the statistics so far and the variantmap itself, pickled.
+"""
+import cPickle as pickle
+import os
+
+__version__ = 3
+
+def stripSamples(record):
+    """Drop the per-sample calls of a record, which aren't needed for merging
+    and can't be pickled"""
+    record.samples = []
+    record._sample_indexes = {}
+    return record
+
+def save(filename, state):
+    """Write a checkpoint atomically, so a crash leaves the previous one"""
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as checkpointfile:
+        pickle.dump(dict(state, version=__version__), checkpointfile, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpname, filename)
+
+def load(filename, inputs, labels, settings):
+    """Read a checkpoint, checking it was made by the same merge"""
+    with open(filename, 'rb') as checkpointfile:
+        state = pickle.load(checkpointfile)
+    if state.get('version') != __version__:
+        raise ValueError("Checkpoint %s was written by an incompatible version" % filename)
+    if state['inputs'] != list(inputs) or state['labels'] != list(labels) or state['settings'] != settings:
+        raise ValueError("Checkpoint %s was made for a different merge" % filename)
+    return state
+
+def remove(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,230 @@
+"""
+Parsing a single large VCF in parallel.  The file is split into byte ranges
+- at line starts for uncompressed files, at block boundaries for BGZF - and
+each range is parsed, filtered and normalized by a worker process; the
+results come back in file order, so merging them gives the same result as
+reading the file from start to finish.
+
+An uncompressed line belongs to the range its first byte is in.  Whether a
+BGZF block starts a line isn't known without inflating the block before it,
+so a BGZF line belongs to the range holding the newline that ends the line
+before it: each range after the first skips its text through its first
+newline, and each range reads on through the first newline after its end.
+Only the block headers are read to find the ranges.
+"""
+import collections
+import itertools
+import struct
+import zlib
+import vcf
+import mergevcf.checkpoint as checkpointing
+import mergevcf.partition as partition
+import mergevcf.variantdict as variantdict
+
+# approximate size of each range, in (compressed) bytes
+__chunksize__ = 8 * 1024**2
+
+__bgzfmagic__ = '\x1f\x8b\x08\x04'
+
+chunk = collections.namedtuple('chunk', ['filename', 'bgzf', 'start', 'end', 'skipfirst'])
+
+def isBGZF(filename):
+    with open(filename, 'rb') as infile:
+        header = infile.read(18)
+    return len(header) == 18 and header[:4] == __bgzfmagic__ and header[12:14] == 'BC'
+
+def splittable(filename):
+    """Can the file be split into ranges: uncompressed, or BGZF?"""
+    if filename.endswith('.gz'):
+        return isBGZF(filename)
+    with open(filename, 'rb') as infile:
+        return infile.read(2) != '\x1f\x8b'
+
+def _blockheader(infile, offset):
+    """Reads the header of the BGZF block at offset, returning its (total
+    size - 1, extra field length), or (None, None) at the end of the file"""
+    infile.seek(offset)
+    header = infile.read(12)
+    if len(header) < 12:
+        return None, None
+    if header[:4] != __bgzfmagic__:
+        raise ValueError("Not a BGZF block at offset %d of %s" % (offset, infile.name))
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = infile.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        slen, = struct.unpack('<H', extra[pos+2:pos+4])
+        if extra[pos:pos+2] == 'BC':
+            bsize, = struct.unpack('<H', extra[pos+4:pos+6])
+        pos += 4 + slen
+    if bsize is None:
+        raise ValueError("No BGZF block size at offset %d of %s" % (offset, infile.name))
+    return bsize, xlen
+
+def _readblock(infile, offset):
+    """Returns (uncompressed text, offset of the next block) for the BGZF
+    block at offset, or (None, offset) at the end of the file"""
+    bsize, xlen = _blockheader(infile, offset)
+    if bsize is None:
+        return None, offset
+    data = infile.read(bsize - xlen - 19)
+    return zlib.decompress(data, -15), offset + bsize + 1
+
+def bgzfBlocks(filename):
+    """Offsets of the BGZF blocks of a file, from their headers alone"""
+    offsets = []
+    with open(filename, 'rb') as infile:
+        offset = 0
+        while True:
+            bsize, _ = _blockheader(infile, offset)
+            if bsize is None:
+                break
+            offsets.append(offset)
+            offset += bsize + 1
+    return offsets
+
+def chunkRanges(filename, start=0, chunksize=None):
+    """
+    Split a file from offset start into chunks of about chunksize bytes.
+    start must be the start of a line (uncompressed) or of a block (BGZF).
+    """
+    if chunksize is None:
+        chunksize = __chunksize__
+
+    chunks = []
+    if not isBGZF(filename):
+        with open(filename, 'rb') as infile:
+            infile.seek(0, 2)
+            size = infile.tell()
+            while start < size:
+                infile.seek(min(start + chunksize, size))
+                infile.readline()
+                end = min(infile.tell(), size)
+                chunks.append(chunk(filename, False, start, end, False))
+                start = end
+        return chunks
+
+    offsets = bgzfBlocks(filename)
+    i = next((i for i, offset in enumerate(offsets) if offset >= start), len(offsets))
+    while i < len(offsets):
+        j = i + 1
+        while j < len(offsets) and offsets[j] - offsets[i] < chunksize:
+            j += 1
+        end = offsets[j] if j < len(offsets) else offsets[-1] + 1
+        chunks.append(chunk(filename, True, offsets[i], end, offsets[i] > 0))
+        i = j
+    return chunks
+
+def _plainlines(c):
+    with open(c.filename, 'rb') as infile:
+        infile.seek(c.start)
+        position = c.start
+        while position < c.end:
+            line = infile.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+def _bgzflines(c):
+    """The lines of a chunk: those after a newline in its blocks, or from
+    the start of the file for the first"""
+    with open(c.filename, 'rb') as infile:
+        texts = []
+        offset = c.start
+        while offset < c.end:
+            text, offset = _readblock(infile, offset)
+            if text is None:
+                break
+            texts.append(text)
+        text = ''.join(texts)
+
+        # read on through the first newline after the chunk, which the next one skips to
+        while True:
+            more, offset = _readblock(infile, offset)
+            if more is None:
+                break
+            newline = more.find('\n')
+            if newline >= 0:
+                text += more[:newline+1]
+                break
+            text += more
+
+    if c.skipfirst:
+        text = text[text.find('\n')+1:] if '\n' in text else ''
+    return text.splitlines(True)
+
+def _parseChunk(args):
+    """
+    Parse, filter and normalize the records of a chunk.  Returns
+    (list of (record, normalized variants), error), where error is None
+    or the (type name, message) of an error that ended the chunk early.
+    """
+    c, header, forceSV, noFilter, filterByChromosome = args
+    import mergevcf.mergedfile as mergedfile
+
+    lines = _bgzflines(c) if c.bgzf else _plainlines(c)
+    records = []
+    error = None
+    try:
+        reader = vcf.Reader(itertools.chain(header, (line for line in lines if not line.startswith('#'))))
+        for record in reader:
+            if not (record.FILTER is None or len(record.FILTER) == 0 or noFilter):
+                continue
+            if filterByChromosome and not mergedfile.mapped_to_chromosome(record.CHROM):
+                continue
+            records.append(checkpointing.stripSamples(record))
+    except (RuntimeError, TypeError, NameError, AttributeError) as err:
+        error = (type(err).__name__, str(err))
+
+    try:
+        variants = variantdict.normalizedVariantsBatch(records, forceSV)
+    except (RuntimeError, TypeError, NameError, AttributeError) as err:
+        # keep the records before the one that failed, as addrecords would
+        variants = []
+        for record in records:
+            try:
+                variants.append(variantdict.normalizedVariants(record, forceSV))
+            except (RuntimeError, TypeError, NameError, AttributeError) as err:
+                error = (type(err).__name__, str(err))
+                break
+    return zip(records, variants), error
+
+def readHeader(filename):
+    """The header lines of a (possibly gzipped) VCF"""
+    header = []
+    with partition.openVCF(filename) as infile:
+        for line in infile:
+            if not line.startswith('#'):
+                break
+            header.append(line)
+    return header
+
+def parseChunks(filename, forceSV=False, noFilter=False, filterByChromosome=True,
+                pool=None, nworkers=1, start=0):
+    """
+    Generates (chunk, list of (record, normalized variants), error) for the
+    chunks of a file from offset start, in file order, parsed by a
+    multiprocessing pool if given.  At most twice nworkers chunks are
+    parsed ahead of the one being consumed.
+    """
+    header = readHeader(filename)
+    tasks = ((c, header, forceSV, noFilter, filterByChromosome) for c in chunkRanges(filename, start))
+    if pool is None:
+        for task in tasks:
+            pairs, error = _parseChunk(task)
+            yield task[0], pairs, error
+        return
+
+    pending = collections.deque()
+    for task in tasks:
+        pending.append((task[0], pool.apply_async(_parseChunk, (task,))))
+        if len(pending) >= 2 * nworkers:
+            c, result = pending.popleft()
+            pairs, error = result.get()
+            yield c, pairs, error
+    while pending:
+        c, result = pending.popleft()
+        pairs, error = result.get()
+        yield c, pairs, error
@@ -0,0 +1,317 @@
+"""
+Merging per-sample merged VCFs into a cohort-wide catalogue of sites.
+Each sample's calls are clustered with the same windows as a merge, but
+sites only remember which samples support them - as delta-encoded sorted
+sample ids, a compressed form of the sample bitset - and the mean position
+of the supporting calls, rather than the records themselves.
+"""
+import argparse
+import array
+import json
+import os
+import re
+import sys
+from mergevcf.locations import locationdict, location
+from mergevcf.vcftobreakpoints import chromSortKey
+import mergevcf.jobs as jobs
+import mergevcf.memory as memory
+import mergevcf.mergedfile as mergedfile
+import mergevcf.partition as partition
+import mergevcf.variantdict as variantdict
+
+# how many lines to read between checks of memory use
+__memcheckinterval__ = 10000
+
+__breakendRE__ = re.compile(r'^([A-Za-z.]*)([\[\]])([^\[\]:]+):(\d+)([\[\]])([A-Za-z.]*)$')
+__looseendRE__ = re.compile(r'^(?:[A-Za-z]+\.|\.[A-Za-z]+)$')
+
+def parseSite(line):
+    """
+    The chromosome and variant tuples of a merged VCF record line: the
+    (location, location) breakpoint pair written for an SV, with an
+    unplaced location(None, 0) mate for a loose end (eg N.), or
+    (location, (ref, alt)) for each allele of other variants
+    """
+    fields = line.split('\t', 8)
+    chrom, pos, ref, alts = fields[0], int(fields[1]), fields[3], fields[4]
+
+    if __looseendRE__.match(alts):
+        return chrom, [(location(chrom, pos, True, alts.endswith('.')), location(None, 0))]
+
+    breakend = __breakendRE__.match(alts)
+    if breakend is None:
+        return chrom, [(location(chrom, pos), (ref, alt)) for alt in alts.split(',') if alt != '.']
+
+    # the inverse of mergedfile.bkptRefAltFromPair
+    pre, delim, chrom2, pos2 = breakend.group(1), breakend.group(2), breakend.group(3), int(breakend.group(4))
+    right1 = len(pre) == 0
+    right2 = delim == '['
+    loc1 = location(chrom, pos, True, right1)
+    loc2 = location(chrom2, pos2, right1 != right2, right2)
+    return chrom, [(loc1, loc2)]
+
+def _passed(line):
+    filterfield = line.split('\t', 7)[6]
+    return filterfield in ['.', 'PASS', '']
+
+def sampleLines(filenames, noFilter=False, filterByChromosome=True):
+    """Generates (sample index, record line) for the calls of each per-sample
+    merged VCF in turn; the commented-out input records are skipped"""
+    for idx, filename in enumerate(filenames):
+        with partition.openVCF(filename) as infile:
+            for line in infile:
+                if line.startswith('#') or not line.strip():
+                    continue
+                if not (noFilter or _passed(line)):
+                    continue
+                if filterByChromosome and not mergedfile.mapped_to_chromosome(line.split('\t', 1)[0]):
+                    continue
+                yield idx, line
+
+def rangeString(ids):
+    """Sorted integers as a compact list of ranges, eg 0-3,7,9-10"""
+    ranges = []
+    for i in ids:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
+
+class sitecatalogue(object):
+    """
+    Sites clustered from the calls of many samples.  Each site keeps the
+    ids of its supporting samples as a bytearray of varint-encoded gaps
+    between successive ids; samples must be added in increasing order.
+    """
+    def __init__(self, svwindow):
+        self.__alleledict = locationdict(0)
+        self.__svdict = variantdict.locationpairdict(svwindow)
+        self.__keys = []
+        self.__members = []
+        self.__lastsample = array.array('l')
+        self.__nsamples = array.array('l')
+        self.__ncalls = array.array('l')
+        self.__possums = array.array('l')
+        self.__matepossums = array.array('l')
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __newsite(self, vartuple):
+        self.__keys.append(vartuple)
+        self.__members.append(bytearray())
+        self.__lastsample.append(-1)
+        for column in [self.__nsamples, self.__ncalls, self.__possums, self.__matepossums]:
+            column.append(0)
+        return len(self.__keys) - 1
+
+    def __site(self, vartuple):
+        locn, other = vartuple
+        if type(other) is location:
+            if (locn, other) in self.__svdict:
+                return self.__svdict[(locn, other)][0]
+            site = self.__newsite(vartuple)
+            self.__svdict[(locn, other)] = site
+            return site
+
+        if not locn in self.__alleledict:
+            self.__alleledict[locn] = {}
+        alleles = self.__alleledict[locn]
+        if not other in alleles:
+            alleles[other] = self.__newsite(vartuple)
+        return alleles[other]
+
+    def add(self, sample, vartuple):
+        """Add a call of the variant tuple by sample"""
+        site = self.__site(vartuple)
+        self.__ncalls[site] += 1
+        self.__possums[site] += vartuple[0].pos
+        if type(vartuple[1]) is location:
+            self.__matepossums[site] += vartuple[1].pos
+
+        last = self.__lastsample[site]
+        if last == sample:
+            return
+        if sample < last:
+            raise ValueError("Samples must be added in order")
+        gap = sample - last - 1
+        members = self.__members[site]
+        while gap >= 0x80:
+            members.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        members.append(gap)
+        self.__lastsample[site] = sample
+        self.__nsamples[site] += 1
+
+    def samples(self, site):
+        """The sorted sample ids supporting a site"""
+        ids = []
+        sample, gap, shift = -1, 0, 0
+        for byte in self.__members[site]:
+            gap |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            sample += gap + 1
+            ids.append(sample)
+            gap, shift = 0, 0
+        return ids
+
+    def nsamples(self, site):
+        return self.__nsamples[site]
+
+    def sites(self):
+        """Generates (site, location, location or allele, mean position, mean
+        mate position) in order of chromosome and position"""
+        def sortkey(site):
+            locn, other = self.__keys[site]
+            if type(other) is location:
+                return chromSortKey(locn.chrom), locn.pos, 1, chromSortKey(other.chrom), other.pos, ()
+            return chromSortKey(locn.chrom), locn.pos, 0, (), 0, other
+
+        for site in sorted(range(len(self.__keys)), key=sortkey):
+            locn, other = self.__keys[site]
+            ncalls = self.__ncalls[site]
+            matepos = self.__matepossums[site] // ncalls if type(other) is location else None
+            yield site, locn, other, self.__possums[site] // ncalls, matepos
+
+def catalogueHeader(labels, min_samples):
+    header = ["##fileformat=VCFv4.1",
+              '##INFO=<ID=NumSamples,Number=1,Type=Integer,Description="Number of samples with this site">',
+              '##INFO=<ID=Samples,Number=.,Type=String,Description="Indices of the samples with this site, as ranges">']
+    if min_samples > 0:
+        header.append('##FILTER=<ID=LOWFREQ,Description="Fewer than %d samples have this site">' % min_samples)
+    header += ["##sample=<Index=%d,ID=%s>" % (i, label) for i, label in enumerate(labels)]
+    header.append("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO"]))
+    return "\n".join(header) + "\n"
+
+def writeSites(catalogue, outfile, min_samples=0):
+    """Write the sites of a catalogue as VCF records; returns the number written"""
+    nsites = 0
+    for site, locn, other, pos, matepos in catalogue.sites():
+        if type(other) is location and other.chrom == str(None):
+            ref, alt = "N", "N." if locn.__right__ else ".N"
+        elif type(other) is location:
+            ref, alt = mergedfile.bkptRefAltFromPair(locn.withPos(pos), other.withPos(matepos))
+        else:
+            ref, alt = other
+        nsamples = catalogue.nsamples(site)
+        filterstring = "." if nsamples >= min_samples else "LOWFREQ"
+        info = "NumSamples=%d;Samples=%s" % (nsamples, rangeString(catalogue.samples(site)))
+        outfile.write("\t".join([locn.chrom, str(pos), ".", ref, alt, ".", filterstring, info]) + "\n")
+        nsites += 1
+    return nsites
+
+def cohortMerge(filenames, labels, outfile, svwindow=jobs.defsvwindow, min_samples=0,
+                noFilter=False, filterByChromosome=True, maxMemory=None):
+    """
+    Merge per-sample merged VCFs into a catalogue of sites, written as VCF
+    to outfile.  If maxMemory (in bytes) is given and clustering gets close
+    to it, the calls are instead partitioned by chromosome through
+    temporary files and each chromosome catalogued separately, with the
+    same output; a MemoryError is raised if a partition doesn't fit.
+    Returns a dictionary of statistics.
+    """
+    stats = {'samples': len(filenames), 'calls': 0, 'sites': 0}
+    budget = None
+    if maxMemory is not None:
+        budget = memory.memorybudget(maxMemory)
+
+    outfile.write(catalogueHeader(labels, min_samples))
+
+    catalogue = sitecatalogue(svwindow)
+    overbudget = False
+    for n, (sample, line) in enumerate(sampleLines(filenames, noFilter, filterByChromosome)):
+        for vartuple in parseSite(line)[1]:
+            catalogue.add(sample, vartuple)
+        stats['calls'] += 1
+        if budget is not None and n % __memcheckinterval__ == 0 and budget.nearlyExceeded():
+            overbudget = True
+            break
+
+    if not overbudget:
+        stats['sites'] = writeSites(catalogue, outfile, min_samples)
+        return stats
+
+    # Partition the calls by chromosome, and catalogue one at a time
+    catalogue = None
+    stats['calls'] = 0
+    spill = partition.spillfiles()
+    try:
+        for sample, line in sampleLines(filenames, noFilter, filterByChromosome):
+            spill.write(line.split('\t', 1)[0], sample, line)
+            stats['calls'] += 1
+
+        stats['partitions'] = len(spill.keys())
+        for chrom in sorted(spill.keys(), key=chromSortKey):
+            catalogue = sitecatalogue(svwindow)
+            nlines = 0
+            for sample, lines in spill.read(chrom):
+                for line in lines:
+                    for vartuple in parseSite(line)[1]:
+                        catalogue.add(sample, vartuple)
+                    nlines += 1
+                    if nlines % __memcheckinterval__ == 0 and budget.exceeded():
+                        raise MemoryError("Sites on chromosome %s (%d calls) exceeded the budget of %s after %d calls"
+                                          % (chrom, spill.count(chrom), memory.megabytes(maxMemory), nlines))
+            if budget.exceeded():
+                raise MemoryError("Sites on chromosome %s need more than the budget of %s"
+                                  % (chrom, memory.megabytes(maxMemory)))
+            stats['sites'] += writeSites(catalogue, outfile, min_samples)
+            catalogue = None
+    finally:
+        spill.cleanup()
+    return stats
+
+def readSampleList(listfile):
+    """Read a list of per-sample merged VCFs, one per line, optionally
+    followed by a tab and the sample name; paths are relative to the list"""
+    listdir = os.path.dirname(os.path.abspath(listfile.name))
+    filenames, labels = [], []
+    for line in listfile:
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        filename = os.path.join(listdir, fields[0].strip())
+        filenames.append(filename)
+        if len(fields) > 1 and fields[1].strip():
+            labels.append(fields[1].strip())
+        else:
+            labels.append(jobs.defaultLabels([filename])[0])
+    return filenames, labels
+
+def cohortMain(argv):
+    """Entry point for mergevcf cohort"""
+    parser = argparse.ArgumentParser(prog='mergevcf cohort',
+                                     description='Merge per-sample merged VCFs into a catalogue of sites')
+    parser.add_argument('input_files', nargs='*', help='Per-sample merged VCF files')
+    parser.add_argument('-i', '--sample-list', type=argparse.FileType('r'),
+                        help='File listing the per-sample merged VCFs, one per line, optionally followed by a tab and the sample name')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Specify output file (default:stdout)")
+    parser.add_argument('-l', '--labels', type=str, help='Comma-separated sample names for each input file (default:basenames)')
+    parser.add_argument('-m', '--min-samples', type=int, default=0, help='Minimum # of samples for a site to pass')
+    parser.add_argument('-f', '--filtered', action='store_true', help='Include calls that failed a filter, eg LOWSUPPORT (default:false)')
+    parser.add_argument('-w', '--svwindow', default=jobs.defsvwindow, type=int,
+                         help='Window for comparing breakpoint positions for SVs (default:'+str(jobs.defsvwindow)+')')
+    parser.add_argument('--max-memory', type=memory.parseMemorySize,
+                        help='Memory budget, eg 4G; larger cohorts are partitioned by chromosome through temporary files (default:none)')
+    parser.add_argument('--stats', type=str, help='Write statistics about the merge, as JSON, to this file')
+    args = parser.parse_args(argv)
+
+    if args.sample_list is not None:
+        if len(args.input_files) > 0 or args.labels is not None:
+            parser.error("Input files and labels can't be given with --sample-list")
+        filenames, labels = readSampleList(args.sample_list)
+    else:
+        filenames, labels = args.input_files, jobs.labelsFromArgs(args)
+    if len(filenames) == 0:
+        parser.error("No input files given")
+    if len(labels) != len(filenames):
+        parser.error("Number of labels (%d) does not match number of inputs (%d)" % (len(labels), len(filenames)))
+
+    stats = cohortMerge(filenames, labels, args.output, args.svwindow, args.min_samples,
+                        noFilter=args.filtered, maxMemory=args.max_memory)
+    if args.stats is not None:
+        with open(args.stats, 'w') as statsfile:
+            json.dump(stats, statsfile, indent=2)
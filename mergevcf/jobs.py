@@ -0,0 +1,241 @@
+"""
+Merge jobs: a merge described as a dictionary of inputs, labels, options and
+output path, so that it can be run from the command line, by the merge
+server, or by a batch of merges listed in a manifest.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import mergevcf.mergedfile as mergedfile
+import mergevcf.memory as memory
+import mergevcf.progress as progress
+
+defsvwindow = 100
+
+defaultOptions = {'sv': False, 'svwindow': defsvwindow, 'ncallers': False,
+                  'mincallers': 0, 'filtered': False, 'verbose': False,
+                  'maxmemory': None, 'progress': None, 'progressinterval': 5.0,
+                  'hotspotlimit': None, 'checkpoint': None, 'checkpointinterval': 300.,
+                  'resume': False, 'parsejobs': 1, 'passonly': False, 'sorted': False}
+
+def addMergeArguments(parser, outputAsPath=False, manifest=False):
+    """Add the options describing a merge to an argparse parser, and
+    optionally those for running a manifest of merges"""
+    parser.add_argument('input_files', nargs='*' if manifest else '+', help='Input VCF files')
+    if outputAsPath:
+        parser.add_argument('-o', '--output', type=str, required=True, help="Specify output file")
+    else:
+        parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Specify output file (default:stdout)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Specify verbose output")
+    parser.add_argument('-l', '--labels', type=str, help='Comma-separated labels for each input VCF file (default:basenames)')
+    parser.add_argument('-n', '--ncallers', action='store_true', help='Annotate variant with number of callers')
+    parser.add_argument('-m', '--mincallers', type=int, default=0, help='Minimum # of callers for variant to pass')
+    parser.add_argument('--pass-only', action='store_true',
+                        help='Drop variants with fewer than --mincallers callers rather than writing them as LOWSUPPORT')
+    parser.add_argument('-s', '--sv', action='store_true', help='Force interpretation as SV (default:false)')
+    parser.add_argument('-f', '--filtered', action='store_true', help='Include records that have failed one or more filters (default:false)')
+    parser.add_argument('-w', '--svwindow', default=defsvwindow, type=int,
+                         help='Window for comparing breakpoint positions for SVs (default:'+str(defsvwindow)+')')
+    parser.add_argument('--max-memory', type=memory.parseMemorySize,
+                        help='Memory budget, eg 4G; larger merges are partitioned by chromosome through temporary files (default:none)')
+    parser.add_argument('--progress', type=str, nargs='?', const='-',
+                        help='Report progress as JSON lines to this file, or stderr if none given (default:off)')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='Seconds between progress reports (default:5)')
+    parser.add_argument('--stats', type=str, help='Write statistics about the merge, as JSON, to this file')
+    parser.add_argument('--hotspot-limit', type=int,
+                        help='Summarize SV clusters of more than this many records from a sample of them (default:off)')
+    parser.add_argument('--checkpoint', type=str,
+                        help='Periodically save the state of the merge to this file, to --resume from (default:off)')
+    parser.add_argument('--checkpoint-interval', type=float, default=300., help='Seconds between checkpoints (default:300)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from the --checkpoint file if it exists, rather than starting again')
+    parser.add_argument('--parse-jobs', type=int, default=1,
+                        help='Number of processes parsing each uncompressed or BGZF input in chunks (default:1)')
+    parser.add_argument('--sorted', action='store_true',
+                        help='Inputs are sorted by position, with contigs in ##contig header order or else numbered '
+                             'chromosomes first; merge them as a stream, '
+                             'writing each variant once no record still to come can join it (same calls as unsorted)')
+    if manifest:
+        parser.add_argument('--manifest', type=str,
+                            help='TSV of merges to run, one sample per row: output, comma-separated input files, '
+                                 'and optionally comma-separated labels and a memory limit. '
+                                 'The summary report is written to --output')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of manifest merges to run at once (default:1)')
+        parser.add_argument('--sample-max-memory', type=str, help='Memory limit for each manifest merge, eg 4G (default:none)')
+
+def defaultLabels(input_files):
+    """Labels for input files: their basenames without extension"""
+    return [os.path.splitext(os.path.basename(f))[0] for f in input_files]
+
+def labelsFromArgs(args):
+    if args.labels is None:
+        return defaultLabels(args.input_files)
+    return [label.strip() for label in args.labels.split(',')]
+
+def optionsFromArgs(args):
+    """Merge options from the parsed command line arguments"""
+    return {'sv': args.sv, 'svwindow': args.svwindow, 'ncallers': args.ncallers,
+            'mincallers': args.mincallers, 'filtered': args.filtered,
+            'verbose': args.verbose, 'maxmemory': args.max_memory,
+            'progress': args.progress, 'progressinterval': args.progress_interval,
+            'hotspotlimit': args.hotspot_limit, 'checkpoint': args.checkpoint,
+            'checkpointinterval': args.checkpoint_interval, 'resume': args.resume,
+            'parsejobs': args.parse_jobs, 'passonly': args.pass_only, 'sorted': args.sorted}
+
+def jobFromArgs(args):
+    """Job dictionary from parsed command line arguments; paths are made
+    absolute so that the job can be run from another working directory"""
+    options = optionsFromArgs(args)
+    if options['checkpoint'] is not None:
+        options['checkpoint'] = os.path.abspath(options['checkpoint'])
+    return {'inputs': [os.path.abspath(f) for f in args.input_files],
+            'labels': labelsFromArgs(args),
+            'output': os.path.abspath(args.output),
+            'options': options}
+
+def mergeWithOptions(inputs, labels, outfile, options):
+    """Call mergedfile.merge with a dictionary of options"""
+    opts = dict(defaultOptions)
+    opts.update(options)
+
+    reporter = None
+    progressfile = None
+    if opts['progress'] == '-':
+        reporter = progress.progressreporter(sys.stderr, inputs, labels, opts['progressinterval'])
+    elif opts['progress'] is not None:
+        # server workers run many jobs, so the file is closed after each
+        progressfile = open(opts['progress'], 'a')
+        reporter = progress.progressreporter(progressfile, inputs, labels, opts['progressinterval'])
+
+    try:
+        return mergedfile.merge(inputs, labels, opts['sv'], outfile,
+                                slop=opts['svwindow'], verbose=opts['verbose'],
+                                output_ncallers=opts['ncallers'],
+                                min_num_callers=opts['mincallers'],
+                                filterByChromosome=True, noFilter=opts['filtered'],
+                                maxMemory=opts['maxmemory'], progress=reporter,
+                                hotspotLimit=opts['hotspotlimit'], checkpoint=opts['checkpoint'],
+                                checkpointInterval=opts['checkpointinterval'], resume=opts['resume'],
+                                parseJobs=opts['parsejobs'], passOnly=opts['passonly'],
+                                sortedInputs=opts['sorted'])
+    finally:
+        if progressfile is not None:
+            progressfile.close()
+
+def runJob(job):
+    """Run the merge described by a job dictionary; return its statistics"""
+    inputs = [str(f) for f in job['inputs']]
+    labels = job.get('labels')
+    if labels is None:
+        labels = defaultLabels(inputs)
+    labels = [str(label) for label in labels]
+    if len(labels) != len(inputs):
+        raise ValueError("Number of labels (%d) does not match number of inputs (%d)" % (len(labels), len(inputs)))
+
+    # write to a temporary file so a failed merge never looks up to date
+    start = time.time()
+    tmpoutput = job['output'] + '.tmp'
+    try:
+        stats = mergeWithOptions(inputs, labels, open(tmpoutput, 'w'), job.get('options', {}))
+    except:
+        if os.path.exists(tmpoutput):
+            os.remove(tmpoutput)
+        raise
+    os.rename(tmpoutput, job['output'])
+    stats['output'] = job['output']
+    stats['elapsed'] = time.time() - start
+    return stats
+
+def readManifest(manifestfile):
+    """Read a manifest of merges, returning a list of job dictionaries.
+    Each non-blank, non-comment row is tab-separated: output path,
+    comma-separated input files, and optionally comma-separated labels
+    ('.' for the default) and a memory limit for that merge."""
+    manifestdir = os.path.dirname(os.path.abspath(manifestfile.name))
+
+    def path(filename):
+        return os.path.join(manifestdir, filename.strip())
+
+    def optional(fields, idx):
+        if len(fields) <= idx or fields[idx].strip() in ['', '.']:
+            return None
+        return fields[idx].strip()
+
+    joblist = []
+    for lineno, line in enumerate(manifestfile, 1):
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 2:
+            raise ValueError("Manifest line %d: expected output and input files" % lineno)
+        inputs = [path(f) for f in fields[1].split(',')]
+        labels = optional(fields, 2)
+        if labels is not None:
+            labels = [label.strip() for label in labels.split(',')]
+            if len(labels) != len(inputs):
+                raise ValueError("Manifest line %d: %d labels for %d input files" % (lineno, len(labels), len(inputs)))
+        job = {'inputs': inputs, 'labels': labels, 'output': path(fields[0])}
+        maxmemory = optional(fields, 3)
+        if maxmemory is not None:
+            job['maxmemory'] = memory.parseMemorySize(maxmemory)
+        joblist.append(job)
+    return joblist
+
+def isUpToDate(job):
+    """Is the job's output newer than all of its inputs?"""
+    if not os.path.exists(job['output']):
+        return False
+    outtime = os.path.getmtime(job['output'])
+    return all(os.path.getmtime(f) <= outtime for f in job['inputs'])
+
+def _runManifestJob(job):
+    """Run a job in a pool worker, reporting rather than raising failures"""
+    if isUpToDate(job):
+        return {'output': job['output'], 'status': 'skipped'}
+    try:
+        if job.get('maxmemory') is not None:
+            memory.limitMemory(job['maxmemory'])
+            if job['options'].get('maxmemory') is None:
+                job = dict(job, options=dict(job['options'], maxmemory=job['maxmemory']))
+        stats = runJob(job)
+    except Exception as e:
+        return {'output': job['output'], 'status': 'failed',
+                'error': '%s: %s' % (type(e).__name__, str(e))}
+    stats['status'] = 'ok'
+    return stats
+
+def runManifest(joblist, options, nworkers=1, maxmemory=None):
+    """Run a list of jobs with the given merge options, at most nworkers at
+    a time, each in a fresh process so per-job memory limits don't leak.
+    Returns a list of per-job statistics, in the order of joblist."""
+    for job in joblist:
+        job['options'] = options
+        if job.get('maxmemory') is None:
+            job['maxmemory'] = maxmemory
+
+    pool = multiprocessing.Pool(nworkers, maxtasksperchild=1)
+    try:
+        results = pool.map(_runManifestJob, joblist, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def writeSummary(results, outfile):
+    """Write a summary report of a manifest run"""
+    outfile.write("#output\tstatus\tseconds\trecords\tvariants\tlowsupport\terror\n")
+    for result in results:
+        records = result.get('records', {})
+        fields = [result['output'], result['status'],
+                  "%.2f" % result['elapsed'] if 'elapsed' in result else '.',
+                  str(sum(records.values())) if records else '.',
+                  str(result.get('variants', '.')), str(result.get('lowsupport', '.')),
+                  result.get('error', '.')]
+        outfile.write("\t".join(fields) + "\n")
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    outfile.write("#total\t" + ",".join("%s=%d" % (status, counts[status]) for status in sorted(counts)) + "\n")
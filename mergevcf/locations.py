@@ -93,6 +93,21 @@ class locationdict(dict):
         self.__search = [0] + [item for pm in zip(range(1,window+1),range(-1,-window-1,-1)) for item in pm]
         super(locationdict,self).__init__(*args, **kwargs)
 
+    @classmethod
+    def fromsorted(cls, window, chroms, positions, strands, extents, payloads):
+        """
+        Build a locationdict in one pass from columns of locations and
+        payloads, sorted by position within each chromosome.  Each key
+        maps to the list of payloads grouped with it - the same as adding
+        the rows in order with
+            if locn in ld: ld[locn].append(payload)
+            else: ld[locn] = [payload]
+        """
+        ld = cls(window)
+        for locn, group in _windowgroups(window, chroms, positions, strands, extents, payloads):
+            dict.__setitem__(ld, locn, [payload for locn, payload in group])
+        return ld
+
     def keys(self):
         return super(locationdict, self).keys()
 
@@ -127,3 +142,42 @@ class locationdict(dict):
             raise KeyError(locn.__str__())
         else:
             return super(locationdict, self).__getitem__(locn + foundoff)
+
+    def __delitem__(self, locn):
+        if not type(locn) is location:
+            raise ValueError("Not Location: "+locn.__str__())
+        present, foundoff = self.__find__(locn)
+        if not present:
+            raise KeyError(locn.__str__())
+        super(locationdict, self).__delitem__(locn + foundoff)
+
+def _windowgroups(window, chroms, positions, strands, extents, payloads):
+    """
+    Groups the rows of sorted location columns the way incremental
+    insertion into a locationdict would: a row joins the most recent key
+    of its kind if within window of it, and starts a new key otherwise.
+    Returns a list of (key, [(location, payload), ...]).
+
+    Locations hash and compare equal when both strand and extent are
+    flipped, so those are the same kind of key.
+    """
+    columns = [chroms, positions, strands, extents, payloads]
+    if len(set(len(column) for column in columns)) != 1:
+        raise ValueError("Columns must all be the same length")
+
+    groups = []
+    lastgroup = {}
+    for chrom, pos, strand, extent, payload in zip(*columns):
+        locn = location(chrom, int(pos), strand, bool(extent))
+        kind = (locn.__chrom__, locn.__strand__ != locn.__right__)
+        if kind in lastgroup:
+            key, group = lastgroup[kind]
+            if locn.__pos__ < group[-1][0].__pos__:
+                raise ValueError("Positions not sorted at "+str(locn))
+            if locn.__pos__ - key.__pos__ <= window:
+                group.append((locn, payload))
+                continue
+        group = [(locn, payload)]
+        lastgroup[kind] = (locn, group)
+        groups.append((locn, group))
+    return groups
@@ -0,0 +1,65 @@
+"""
+Routines for specifying and limiting memory use
+"""
+import resource
+
+__units = {'': 1, 'B': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parseMemorySize(sizestr):
+    """Parse a memory size like 512M, 4G or 1000000 (bytes) into bytes"""
+    size = str(sizestr).strip().upper()
+    if size.endswith('B') and len(size) > 1 and size[-2] in __units:
+        size = size[:-1]
+    unit = ''
+    if size and size[-1] in __units:
+        unit = size[-1]
+        size = size[:-1]
+    try:
+        value = float(size)
+    except ValueError:
+        raise ValueError("Invalid memory size: " + str(sizestr))
+    if value <= 0:
+        raise ValueError("Memory size must be positive: " + str(sizestr))
+    return int(value * __units[unit])
+
+def limitMemory(nbytes):
+    """Limit the address space of this process to nbytes; allocations
+    beyond that raise MemoryError"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY and nbytes > hard:
+        nbytes = hard
+    resource.setrlimit(resource.RLIMIT_AS, (nbytes, hard))
+
+def currentRSS():
+    """Resident set size of this process in bytes; falls back to the peak
+    RSS where the current value isn't available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def megabytes(nbytes):
+    return "%.0fMB" % (nbytes / 1024.0**2)
+
+class memorybudget(object):
+    """Tracks the memory use of this process against a budget"""
+    def __init__(self, maxbytes, threshold=0.8):
+        self.maxbytes = maxbytes
+        self.threshold = threshold
+        self.baseline = currentRSS()
+
+    def nearlyExceeded(self):
+        """Is memory use close enough to the budget that we should stop growing?"""
+        return currentRSS() > self.threshold * self.maxbytes
+
+    def exceeded(self):
+        return currentRSS() > self.maxbytes
+
+    def bytesPerItem(self, nitems):
+        """Estimate the memory used per item, given nitems are now held"""
+        return max(currentRSS() - self.baseline, 0) / float(max(nitems, 1))
+
+    def estimate(self, nitems, bytesperitem):
+        """Estimated memory use with nitems of bytesperitem held"""
+        return self.baseline + int(nitems * bytesperitem)
@@ -1,5 +1,29 @@
+import bisect
+import heapq
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import time
 import vcf
 import mergevcf.variantdict as variantdict
+import mergevcf.checkpoint as checkpointing
+import mergevcf.chunked as chunked
+import mergevcf.memory as memory
+import mergevcf.partition as partition
+import mergevcf.vcftobreakpoints as svvcf
+
+# how many records to normalize and add at once
+__batchsize__ = 1000
+
+# how many records to add between checks of memory use
+__memcheckinterval__ = 1000
+
+# breakend mates in ALT, and END/CHR2 in INFO, for finding mates earlier in a sorted input
+__mateRE__ = re.compile(r'[\[\]]([^\[\]:]+):(\d+)[\[\]]')
+__endRE__ = re.compile(r'(?:^|;)END=(\d+)')
+__chr2RE__ = re.compile(r'(?:^|;)CHR2=([^;\s]+)')
 
 def mapped_to_chromosome(chrom):
     """
@@ -67,10 +91,123 @@ def bkptRefAltFromPair(loc1, loc2, refstr="N"):
     return refstr, altstr
 
 
+class heldgroups(object):
+    """
+    SV records held back from a streamed merge.  Which cluster a record
+    joins depends on the records added before it with a first breakpoint
+    within the window of its own, so records are held in groups linked by
+    their first breakpoints, and a group is released once no record still
+    to come can join it: the stream has passed it, and every record listed
+    in arrivals (contig -> (mate positions, keys)) as reported after an
+    earlier mate near it has been read.  Keys are (contig key, position).
+    """
+    def __init__(self, link, arrivals):
+        self.__link = link
+        self.__arrivals = arrivals
+        self.__spans = {}          # contig key -> sorted [lo, hi, group]
+        self.__queue = []          # (ready key, serial, group)
+        self.__serial = 0
+
+    def __latest(self, contig, lo, hi):
+        """The last arrival of a record with a mate near lo..hi"""
+        positions, keys = self.__arrivals.get(contig, ([], []))
+        first = bisect.bisect_left(positions, lo - self.__link)
+        last = bisect.bisect_right(positions, hi + self.__link)
+        return max(keys[first:last]) if first < last else None
+
+    def add(self, keys, item):
+        """Hold an item with first breakpoints at keys"""
+        link = self.__link
+        groups = []
+        for contig, pos in keys:
+            spans = self.__spans.get(contig, [])
+            i = bisect.bisect_right(spans, [pos + link, float('inf')]) - 1
+            while i >= 0 and spans[i][1] + link >= pos:
+                if not spans[i][2] in groups:
+                    groups.append(spans[i][2])
+                i -= 1
+
+        group = {'items': [], 'spans': []}
+        points = [(contig, pos, pos) for contig, pos in keys]
+        for old in groups:
+            group['items'].extend(old['items'])
+            points.extend(old['spans'])
+            for contig, lo, hi in old['spans']:
+                spans = self.__spans[contig]
+                del spans[bisect.bisect_left(spans, [lo, hi])]
+            old['spans'] = None
+        group['items'].append(item)
+
+        for contig, lo, hi in sorted(points):
+            if group['spans'] and group['spans'][-1][0] == contig and lo <= group['spans'][-1][2] + link:
+                group['spans'][-1] = (contig, group['spans'][-1][1], max(hi, group['spans'][-1][2]))
+            else:
+                group['spans'].append((contig, lo, hi))
+        ready = None
+        for contig, lo, hi in group['spans']:
+            bisect.insort(self.__spans.setdefault(contig, []), [lo, hi, group])
+            ready = max(ready, (contig, hi + link), self.__latest(contig, lo, hi))
+        self.__serial += 1
+        heapq.heappush(self.__queue, (ready, self.__serial, group))
+
+    def __release(self, group):
+        for contig, lo, hi in group['spans']:
+            spans = self.__spans[contig]
+            del spans[bisect.bisect_left(spans, [lo, hi])]
+        group['spans'] = None
+        return group['items']
+
+    def released(self, key):
+        """Remove and return the item lists of groups no record at key or
+        later can join"""
+        released = []
+        while self.__queue and self.__queue[0][0] < key:
+            _, _, group = heapq.heappop(self.__queue)
+            if group['spans'] is not None:
+                released.append(self.__release(group))
+        return released
+
+    def remaining(self):
+        """Remove and return the item lists of all the groups"""
+        released = [self.__release(group) for _, _, group in sorted(self.__queue)
+                    if group['spans'] is not None]
+        self.__queue = []
+        return released
+
+
 def merge(filenames, programs, forceSV, outfile, slop=0, verbose=True,
         output_ncallers=False, min_num_callers=0,
-        filterByChromosome=True, noFilter=False):
-    """Merge several VCFs from different programs into a new VCF file."""
+        filterByChromosome=True, noFilter=False, maxMemory=None,
+        progress=None, hotspotLimit=None, checkpoint=None,
+        checkpointInterval=300., resume=False, parseJobs=1,
+        passOnly=False, sortedInputs=False):
+    """Merge several VCFs from different programs into a new VCF file.
+    If maxMemory (in bytes) is given and the merge gets close to it, the
+    records are instead partitioned by chromosome into temporary files
+    and each partition is merged separately; if a partition is estimated
+    not to fit, a MemoryError is raised.
+    progress, if given, is a progress.progressreporter to keep updated.
+    If hotspotLimit is given, SV clusters of more records than that are
+    summarized from a sample of that many records, flagged HOTSPOT, and
+    listed in the statistics.
+    If checkpoint (a filename) is given, the state of the merge is saved
+    there every checkpointInterval seconds while reading the inputs; with
+    resume, a merge continues from its checkpoint if there is one.  The
+    checkpoint is removed once the output is written.
+    With parseJobs > 1, uncompressed and BGZF inputs are split into chunks
+    parsed by that many processes.
+    With passOnly, variants called by fewer than min_num_callers callers
+    are dropped without being summarized or written, and counted under
+    'dropped'; variants not written for an unmapped mate or a missing
+    allele are counted under 'skipped'.  With sortedInputs, the inputs -
+    each sorted by position, with contigs in the order of their ##contig
+    headers, or else numbered chromosomes first in number order and the
+    others by name - are read together as one stream, and each variant is
+    written and freed once no record still to come can join it, giving
+    the same calls as an unsorted merge; this can't be combined with
+    maxMemory, checkpoint or parseJobs.
+    Returns a dictionary of statistics about the merge; errors that ended
+    an input early are listed under 'errors'."""
 
     # Returns true if the variant is PASS in the VCF file
     def passed_variant(record):
@@ -91,14 +228,21 @@ def merge(filenames, programs, forceSV, outfile, slop=0, verbose=True,
                     res = res[0]
                 infostring = infostring + ';'+field+'='+str(res)
         if output_ncallers:
-            infostring = infostring + ";NumCallers=" + str(len(callers))
+            infostring = infostring + ";NumCallers=" + str(len(set(callers)))
         return "Callers="+",".join(list(set(callers)))+infostring
 
-    calldict = variantdict.variantmap(awindow=0, svwindow=slop)
-    for (infile, program) in zip(filenames, programs):
+    def inputError(program, errtype, message, lineno=None):
+        """Report an error that ended reading an input at line lineno"""
+        stats['errors'][program] = {'line': lineno, 'type': errtype, 'error': message}
+        where = " (at line %d)" % lineno if lineno is not None else ""
+        print >>sys.stderr, "Error reading %s%s, skipping the rest of it: %s: %s" % \
+                (program, where, errtype, message)
+
+    def mergeable(vcf_reader, program, lines):
+        """Generate the records from a file that should be merged; an error
+        reading the file ends it"""
         count = 0
         try:
-            vcf_reader = vcf.Reader(open(infile, 'r'))
             for record in vcf_reader:
 
                 if not passed_variant(record):
@@ -109,60 +253,417 @@ def merge(filenames, programs, forceSV, outfile, slop=0, verbose=True,
 
                 if verbose:
                     if count == 0:
-                        print record, program
+                        print >>sys.stderr, record, program
                     count += 1
                     if count == 100:
                         count = 0
 
-                calldict.addrecord(record, program, forceSV)
-        except (RuntimeError, TypeError, NameError, AttributeError):
-            pass 
-    # Write the results in a master vcf file for the sample
+                if checkpoint is not None:
+                    checkpointing.stripSamples(record)
+                yield record
+        except (RuntimeError, TypeError, NameError, AttributeError) as err:
+            inputError(program, type(err).__name__, str(err), lines.nlines)
+
+    def writeHeader():
+        outfile.write('##fileformat=VCFv4.1\n')
+        outfile.write('##INFO=<ID=Callers,Number=.,Type=String,Description="Callers that made this call">\n')
+        if output_ncallers:
+            outfile.write('##INFO=<ID=NumCallers,Number=1,Type=Integer,Description="Number of callers that made this call">\n')
+        if min_num_callers > 0 and not passOnly:
+            outfile.write('##FILTER=<ID=LOWSUPPORT,Description="Not called by enough callers in ensemble">\n')
+        if hotspotLimit is not None:
+            outfile.write('##INFO=<ID=HOTSPOT,Number=0,Type=Flag,Description="Dense cluster summarized from a sample of its records">\n')
+            outfile.write('##INFO=<ID=NumRecords,Number=1,Type=Integer,Description="Number of records in the summarized cluster">\n')
+        outfile.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+    def writeVariants(calldict, closed=None):
+        """Write out the merged variants; with closed, only those that no
+        later record can join, which are removed from calldict"""
+        nclusters = calldict.nclusters()
+        nwritten = 0
+        for variant in calldict.variants(min_num_callers if passOnly else 0, closed):
+            nwritten += 1
+            callers = variant[2]
+            num_callers = len(set(callers))
+            passes = num_callers >= min_num_callers
+            filterstring = "." if passes else "LOWSUPPORT"
+
+            if len(variant) == 3:   # snv/indel
+                loc, allele, callers = variant
+                if allele is None:
+                    print >>sys.stderr, "Allele is none: loc, allele, callers = ", loc, allele, callers
+                    stats['skipped'] += 1
+                    continue
+                chrom, pos, _, _ = loc.asTuple()
+                vcfline = "\t".join([chrom, str(pos), ".", allele[0], allele[1],
+                                     ".", filterstring,
+                                     "Callers=" + ",".join(callers)])
+                if output_ncallers:
+                    vcfline += ";NumCallers="+str(len(set(callers)))
+                outfile.write(vcfline + "\n")
+            else:
+                loc1, loc2, callers, medianPos1, medianPos2, recordscalled = variant
+                if filterByChromosome and not mapped_to_chromosome(loc2.chrom):
+                    stats['skipped'] += 1
+                    continue
+
+                records = [r for c, r in recordscalled]
+
+                avgloc1 = loc1.withPos(medianPos1)
+                avgloc2 = loc2.withPos(medianPos2)
+                ref, alt = bkptRefAltFromPair(avgloc1, avgloc2)
+                info = infoString(callers, make_info_dict(records, medianPos1, medianPos2))
+                if isinstance(recordscalled, variantdict.reservoir):
+                    info += ";HOTSPOT;NumRecords=%d" % recordscalled.seen
+                    stats['hotspots'].append({'chrom1': avgloc1.__chrom__, 'pos1': medianPos1,
+                                              'chrom2': avgloc2.__chrom__, 'pos2': medianPos2,
+                                              'records': recordscalled.seen,
+                                              'callers': dict(callers)})
+                vcfline = "\t".join([avgloc1.__chrom__, str(avgloc1.__pos__), '.',
+                    ref, alt, '.', filterstring, info])
+                outfile.write(vcfline + "\n")
+                for caller, rec in recordscalled:
+                    outfile.write("#"+str(rec)+" ("+caller+")\n")
+
+            stats['variants'] += 1
+            if not passes:
+                stats['lowsupport'] += 1
+
+        if passOnly:
+            nvisited = nclusters - calldict.nclusters() if closed is not None else nclusters
+            stats['dropped'] += nvisited - nwritten
+
+    def sortedRecords(idx, contigKey):
+        """
+        Generates ((contig key, position, idx, n), record) for the records
+        of sorted input idx to merge; a ValueError is raised if the input
+        is out of order.
+        """
+        infh = partition.openVCF(filenames[idx])
+        lines = partition.linerecorder(infh)
+        try:
+            last = None
+            for n, record in enumerate(mergeable(vcf.Reader(lines), programs[idx], lines)):
+                key = (contigKey(record.CHROM), int(record.POS))
+                if last is not None and key < last[0]:
+                    raise ValueError("%s is not sorted: %s:%d follows %s:%d"
+                                     % (programs[idx], record.CHROM, record.POS, last[1], last[0][1]))
+                last = (key, record.CHROM)
+                yield (key[0], key[1], idx, n), record
+        finally:
+            infh.close()
 
-    outfile.write('##fileformat=VCFv4.1\n')
-    outfile.write('##INFO=<ID=Callers,Number=.,Type=String,Description="Callers that made this call">\n')
-    if output_ncallers:
-        outfile.write('##INFO=<ID=NumCallers,Number=1,Type=Integer,Description="Number of callers that made this call">\n')
-    if min_num_callers > 0:
-        outfile.write('##FILTER=<ID=LOWSUPPORT,Description="Not called by enough callers in ensemble">\n')
-    outfile.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
-
-    for variant in calldict:
-        callers = variant[2]
-        num_callers = len(set(callers))
-        passes = num_callers >= min_num_callers
-        filterstring = "." if passes else "LOWSUPPORT"
-
-        if len(variant) == 3:   # snv/indel
-            loc, allele, callers = variant
-            if allele is None:
-                print("Allele is none: loc, allele, callers = ", loc, allele, callers)
+    def mateArrivals(idx, contigKey):
+        """
+        Lists (mate key, key) for the records of sorted input idx with a
+        breakend mate, or an END, earlier in the stream than themselves;
+        only the text of the records is read
+        """
+        arrivals = []
+        with partition.openVCF(filenames[idx]) as infh:
+            for line in infh:
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t', 8)
+                if len(fields) < 8 or not fields[1].isdigit():
+                    continue
+                key = (contigKey(fields[0]), int(fields[1]))
+                mates = [(m.group(1), int(m.group(2))) for m in __mateRE__.finditer(fields[4])]
+                end = __endRE__.search(fields[7])
+                if end is not None:
+                    chr2 = __chr2RE__.search(fields[7])
+                    mates.append((chr2.group(1) if chr2 is not None else fields[0], int(end.group(1))))
+                for chrom, pos in mates:
+                    matekey = (contigKey(chrom), pos)
+                    if matekey < key:
+                        arrivals.append((matekey, key))
+        return arrivals
+
+    def mergeSorted(calldict):
+        """
+        Merge the sorted inputs as one stream, writing and freeing the
+        variants it has passed.  Small variants only merge at exactly the
+        same position, and are added as they come.  Which SV cluster a
+        record joins depends on the records added before it, so SV records
+        are held in heldgroups until no record still to come - including
+        those reported from a mate later in the stream, found by reading the
+        inputs once beforehand - can join them, and each group is added in
+        input order, as merging the inputs one after the other would.
+        """
+        ranks = {}
+        for infile in filenames:
+            with partition.openVCF(infile) as infh:
+                for contig in vcf.Reader(infh, compressed=False).contigs:
+                    ranks.setdefault(svvcf.stdchrom(contig), len(ranks))
+        def contigKey(chrom):
+            """Contigs in the order of the ##contig headers, then the others"""
+            chrom = svvcf.stdchrom(chrom)
+            if chrom in ranks:
+                return (0, ranks[chrom])
+            return (1,) + svvcf.chromSortKey(chrom)
+
+        position = [None]
+        def closed(locn):
+            """Can no record still to be added join this location?"""
+            if locn.__chrom__ == 'None':
+                return True
+            contig = contigKey(locn.__chrom__)
+            return contig < position[0][0] or (contig == position[0][0] and locn.__pos__ + slop < position[0][1])
+
+        if progress is not None:
+            progress.startInput(None, None, phase='sorted')
+        arrivals = {}
+        for idx in range(len(filenames)):
+            for (contig, pos), key in mateArrivals(idx, contigKey):
+                arrivals.setdefault(contig, []).append((pos, key))
+        for contig, entries in arrivals.items():
+            entries.sort()
+            arrivals[contig] = ([pos for pos, _ in entries], [key for _, key in entries])
+        # a record's breakpoints can be a position before its own or its mate's
+        held = heldgroups(slop + 2, arrivals)
+        def firstKey(locn):
+            # loose ends can share the first breakpoint (None, 0), so are held to the end
+            return ((2,) if locn.__chrom__ == 'None' else contigKey(locn.__chrom__), locn.__pos__)
+
+        def addItems(items):
+            for idx, n, record, variants in sorted(items):
+                program = programs[idx]
+                calldict.addnormalized(variants, program, record)
+                stats['records'][program] = stats['records'].get(program, 0) + 1
+
+        failed = set()
+        nread = 0
+        for key, record in heapq.merge(*[sortedRecords(idx, contigKey) for idx in range(len(filenames))]):
+            idx, n = key[2:]
+            if idx in failed:
                 continue
-            chrom, pos, _, _ = loc.asTuple()
-            vcfline = "\t".join([chrom, str(pos), ".", allele[0], allele[1],
-                                 ".", filterstring,
-                                 "Callers=" + ",".join(callers)])
-            if output_ncallers:
-                vcfline += ";NumCallers="+str(len(set(callers)))
-            outfile.write(vcfline + "\n")
-        else:
-            loc1, loc2, callers, medianPos1, medianPos2, recordscalled = variant
-            if filterByChromosome and not mapped_to_chromosome(loc2.chrom):
+            for items in held.released(key[:2]):
+                addItems(items)
+            try:
+                variants = variantdict.normalizedVariants(record, forceSV)
+            except (RuntimeError, TypeError, NameError, AttributeError) as err:
+                inputError(programs[idx], type(err).__name__, str(err))
+                failed.add(idx)
+                continue
+            if variantdict.isSV(record, forceSV):
+                held.add([firstKey(loc1) for loc1, loc2 in variants], (idx, n, record, variants))
+            else:
+                addItems([(idx, n, record, variants)])
+
+            nread += 1
+            if nread >= __batchsize__:
+                position[0] = key[:2]
+                writeVariants(calldict, closed)
+                if progress is not None:
+                    progress.update(nread, calldict.nclusters())
+                nread = 0
+        for items in held.remaining():
+            addItems(items)
+        writeVariants(calldict)
+
+    stats = {'records': {}, 'variants': 0, 'lowsupport': 0, 'skipped': 0, 'errors': {}}
+    if passOnly:
+        stats['dropped'] = 0
+    if hotspotLimit is not None:
+        stats['hotspots'] = []
+    budget = None
+    if maxMemory is not None:
+        budget = memory.memorybudget(maxMemory)
+        if budget.nearlyExceeded():
+            raise MemoryError("Memory use before merging (%s) is already close to the budget of %s"
+                              % (memory.megabytes(budget.baseline), memory.megabytes(maxMemory)))
+
+    calldict = variantdict.variantmap(awindow=0, svwindow=slop, hotspotlimit=hotspotLimit, callers=programs)
+    if sortedInputs:
+        if maxMemory is not None or checkpoint is not None or parseJobs > 1:
+            raise ValueError("Sorted inputs are merged as a stream, without a memory budget, checkpoints or parse jobs")
+        writeHeader()
+        mergeSorted(calldict)
+        outfile.close()
+        return stats
+
+    settings = {'forceSV': forceSV, 'slop': slop, 'filterByChromosome': filterByChromosome,
+                'noFilter': noFilter, 'hotspotLimit': hotspotLimit}
+    startidx, startoffset, startlines, startchunked = 0, None, 0, False
+    if checkpoint is not None and resume and os.path.exists(checkpoint):
+        state = checkpointing.load(checkpoint, filenames, programs, settings)
+        calldict, stats = state['calldict'], state['stats']
+        startidx, startoffset, startlines = state['input'], state['offset'], state['lines']
+        startchunked = state.get('chunked', False)
+        print >>sys.stderr, "Resuming merge from %s at byte %d of %s" % (checkpoint, startoffset, programs[startidx])
+    lastcheckpoint = time.time()
+
+    def saveCheckpoint(idx, offset, nlines, chunkedinput, calldict):
+        checkpointing.save(checkpoint, {'inputs': list(filenames), 'labels': list(programs),
+                                        'settings': settings, 'input': idx, 'offset': offset,
+                                        'lines': nlines, 'chunked': chunkedinput,
+                                        'stats': stats, 'calldict': calldict})
+
+    def addBatch(calldict, batch, batchlines, program):
+        """Add a batch of records read from batchlines; if one fails, those
+        before it are counted before its exception is raised"""
+        try:
+            calldict.addrecords(batch, program, forceSV)
+        except (RuntimeError, TypeError, NameError, AttributeError) as err:
+            stats['records'][program] += err.recordindex
+            raise
+        stats['records'][program] += len(batch)
+        if progress is not None:
+            progress.update(len(batch), calldict.nclusters())
+
+    # worker processes can't start processes of their own
+    pool = None
+    if parseJobs > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.Pool(parseJobs)
+
+    overbudget = False
+    try:
+        for idx in range(startidx, len(filenames)):
+            infile, program = filenames[idx], programs[idx]
+            stats['records'][program] = stats['records'].get(program, 0)
+            resuming = idx == startidx and startoffset is not None
+
+            if (resuming and startchunked) or (not resuming and pool is not None and chunked.splittable(infile)):
+                if progress is not None:
+                    progress.startInput(idx, None)
+                for c, pairs, error in chunked.parseChunks(infile, forceSV, noFilter, filterByChromosome,
+                                                           pool, parseJobs, startoffset if resuming else 0):
+                    for record, variants in pairs:
+                        calldict.addnormalized(variants, program, record)
+                    stats['records'][program] += len(pairs)
+                    if progress is not None:
+                        progress.update(len(pairs), calldict.nclusters(), position=c.end)
+                    if error is not None:
+                        inputError(program, error[0], error[1])
+                        break
+                    if budget is not None and budget.nearlyExceeded():
+                        overbudget = True
+                        break
+                    if checkpoint is not None and time.time() - lastcheckpoint >= checkpointInterval:
+                        saveCheckpoint(idx, c.end, None, True, calldict)
+                        lastcheckpoint = time.time()
+                if progress is not None:
+                    progress.finishInput(calldict.nclusters())
+                if overbudget:
+                    break
                 continue
 
-            records = [r for c, r in recordscalled]
+            infh = partition.openVCF(infile)
+            lines = partition.linerecorder(infh)
+            if progress is not None:
+                progress.startInput(idx, infh)
+            try:
+                vcf_reader = vcf.Reader(lines)
+                if resuming:
+                    lines.seek(startoffset, startlines)
+                batch, batchlines = [], []
+                for record in mergeable(vcf_reader, program, lines):
+                    batch.append(record)
+                    batchlines.append(lines.nlines)
+                    if len(batch) < __batchsize__:
+                        continue
+                    addBatch(calldict, batch, batchlines, program)
+                    batch, batchlines = [], []
+                    if budget is not None and budget.nearlyExceeded():
+                        overbudget = True
+                        break
+                    if checkpoint is not None and time.time() - lastcheckpoint >= checkpointInterval:
+                        saveCheckpoint(idx, lines.offset, lines.nlines, False, calldict)
+                        lastcheckpoint = time.time()
+                addBatch(calldict, batch, batchlines, program)
+            except (RuntimeError, TypeError, NameError, AttributeError) as err:
+                if hasattr(err, 'recordindex'):
+                    inputError(program, type(err).__name__, str(err), batchlines[err.recordindex])
+                else:
+                    inputError(program, type(err).__name__, str(err), lines.nlines)
+            if progress is not None:
+                progress.finishInput(calldict.nclusters())
+            infh.close()
+            if overbudget:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+    nheld = sum(stats['records'].values())
+    # Write the results in a master vcf file for the sample
+    writeHeader()
+
+    if not overbudget:
+        if progress is not None:
+            progress.report(calldict.nclusters(), phase='output')
+        writeVariants(calldict)
+        outfile.close()
+        if checkpoint is not None:
+            checkpointing.remove(checkpoint)
+        return stats
+
+    # Too big to merge in memory: start again, spilling the records to
+    # files partitioned by chromosome, and merge each partition separately
+    bytesPerRecord = budget.bytesPerItem(nheld)
+    del calldict
+    stats['records'] = {}
+    stats['errors'] = {}
+
+    spill = partition.spillfiles()
+    try:
+        headers = []
+        for idx, (infile, program) in enumerate(zip(filenames, programs)):
+            nrecords = 0
+            infh = partition.openVCF(infile)
+            if progress is not None:
+                progress.startInput(idx, infh, phase='partition')
+            lines = partition.linerecorder(infh)
+            headers.append(lines.header)
+            try:
+                vcf_reader = vcf.Reader(lines)
+                for record in mergeable(vcf_reader, program, lines):
+                    variants = variantdict.normalizedVariants(record, forceSV)
+                    for key in set(variantdict.partitionKey(v) for v in variants):
+                        spill.write(key, idx, lines.line)
+                    nrecords += 1
+                    if progress is not None and nrecords % __memcheckinterval__ == 0:
+                        progress.update(__memcheckinterval__, 0)
+            except (RuntimeError, TypeError, NameError, AttributeError) as err:
+                inputError(program, type(err).__name__, str(err), lines.nlines)
+            stats['records'][program] = stats['records'].get(program, 0) + nrecords
+            if progress is not None:
+                progress.finishInput(0)
+
+        # fail fast if any partition is too big to merge
+        for key in spill.keys():
+            estimate = budget.estimate(spill.count(key), bytesPerRecord)
+            if estimate > maxMemory:
+                raise MemoryError("Merging partition %s (%d records) needs an estimated %s, more than the budget of %s"
+                                  % (key, spill.count(key), memory.megabytes(estimate), memory.megabytes(maxMemory)))
 
-            avgloc1 = loc1.withPos(medianPos1)
-            avgloc2 = loc2.withPos(medianPos2)
-            ref, alt = bkptRefAltFromPair(avgloc1, avgloc2)
-            vcfline = "\t".join([avgloc1.__chrom__, str(avgloc1.__pos__), '.',
-                ref, alt, '.', filterstring,
-                infoString(callers, make_info_dict(records, medianPos1, medianPos2))])
-            outfile.write(vcfline + "\n")
-            for caller, rec in recordscalled:
-                outfile.write("#"+str(rec)+" ("+caller+")\n")
+        stats['partitions'] = len(spill.keys())
+        for key in sorted(spill.keys()):
+            calldict = variantdict.variantmap(awindow=0, svwindow=slop, hotspotlimit=hotspotLimit, callers=programs)
+            nrecords = 0
+            for idx, lines in spill.read(key):
+                vcf_reader = vcf.Reader(itertools.chain(headers[idx], lines))
+                for record in vcf_reader:
+                    variants = [v for v in variantdict.normalizedVariants(record, forceSV)
+                                if variantdict.partitionKey(v) == key]
+                    calldict.addnormalized(variants, programs[idx], record)
+                    nrecords += 1
+                    if nrecords % __memcheckinterval__ == 0:
+                        if budget.exceeded():
+                            raise MemoryError("Merging partition %s (%d records) exceeded the budget of %s after %d records"
+                                              % (key, spill.count(key), memory.megabytes(maxMemory), nrecords))
+                        if progress is not None:
+                            progress.update(__memcheckinterval__, calldict.nclusters())
+            if progress is not None:
+                progress.report(calldict.nclusters(), phase='partition %s' % key)
+            writeVariants(calldict)
+            del calldict
+    finally:
+        spill.cleanup()
 
     outfile.close()
+    if checkpoint is not None:
+        checkpointing.remove(checkpoint)
+    return stats
 
 def readMergedCalls(infile, filterByChromosome=True, readINFO=False, skipcallers=None):
     """Read a merged callset, and return:
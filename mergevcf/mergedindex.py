@@ -0,0 +1,219 @@
+"""
+An index over a merged callset for region and breakpoint queries.  Each
+merged call's position, mate position, set of callers and byte offset in
+the merged VCF are held in numpy arrays sorted by chromosome and position,
+so queries are binary searches; the index can be saved to a directory and
+loaded back memory-mapped.  Requires numpy.
+"""
+import json
+import os
+import re
+import mergevcf.partition as partition
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__columns__ = ['pos', 'matechrom', 'matepos', 'callerbits', 'offset', 'mateorder']
+__breakendRE__ = re.compile(r'[\[\]]([^\[\]:]+):(\d+)[\[\]]')
+__endRE__ = re.compile(r'(?:^|;)END=(\d+)(?:;|$)')
+__callersRE__ = re.compile(r'(?:^|;)Callers=([^;]*)(?:;|$)')
+
+def _parseline(line):
+    """(chrom, pos, mate chrom, mate pos, callers) from a merged VCF record line"""
+    fields = line.split('\t', 8)
+    chrom, pos, ref, alt, info = fields[0], int(fields[1]), fields[3], fields[4], fields[7].strip()
+
+    breakend = __breakendRE__.search(alt)
+    if breakend is not None:
+        matechrom, matepos = breakend.group(1), int(breakend.group(2))
+    else:
+        end = __endRE__.search(info)
+        matechrom = chrom
+        matepos = int(end.group(1)) if end is not None else pos + max(len(ref), 1) - 1
+
+    callers = __callersRE__.search(info)
+    callers = callers.group(1).split(',') if callers is not None else []
+    return chrom, pos, matechrom, matepos, callers
+
+class mergedcallindex(object):
+    """
+    Index of the calls in a merged VCF.  Calls are numbered by their order
+    in the index (by chromosome, then position); queries return arrays of
+    call numbers, which can be looked up with call() or lines().
+    """
+    def __init__(self, filename, chroms, callers, arrays):
+        self.filename = filename
+        self.chroms = chroms
+        self.callers = callers
+        self.__chromids = dict((chrom, i) for i, chrom in enumerate(chroms))
+        for column in __columns__:
+            setattr(self, column, arrays[column])
+
+        # start of each chromosome's calls, by position and by mate position
+        chromids = np.arange(len(chroms) + 1)
+        self.__chromstarts = np.searchsorted(arrays['chrom'], chromids) if 'chrom' in arrays \
+                                else np.asarray(arrays['chromstarts'])
+        self.__matestarts = np.searchsorted(self.matechrom[self.mateorder], chromids)
+
+    @classmethod
+    def build(cls, filename, filterByChromosome=False):
+        """Index the records of the merged VCF filename"""
+        import mergevcf.mergedfile as mergedfile
+
+        chroms, chromids = [], {}
+        callers, callerbits = [], {}
+        def chromid(chrom):
+            if not chrom in chromids:
+                chromids[chrom] = len(chroms)
+                chroms.append(chrom)
+            return chromids[chrom]
+
+        rows = []
+        offset = 0
+        with partition.openVCF(filename) as infile:
+            for line in iter(infile.readline, ''):
+                lineoffset = offset
+                offset += len(line)
+                if line.startswith('#') or not line.strip():
+                    continue
+                chrom, pos, matechrom, matepos, linecallers = _parseline(line)
+                if filterByChromosome and not mergedfile.mapped_to_chromosome(chrom):
+                    continue
+
+                bits = 0
+                for caller in linecallers:
+                    if not caller in callerbits:
+                        if len(callers) == 64:
+                            raise ValueError("Can't index more than 64 callers")
+                        callerbits[caller] = 1 << len(callers)
+                        callers.append(caller)
+                    bits |= callerbits[caller]
+                rows.append((chromid(chrom), pos, chromid(matechrom), matepos, bits, lineoffset))
+
+        # chromosomes are numbered in sorted order, so the index is sorted too
+        order = sorted(range(len(chroms)), key=lambda i: chroms[i])
+        renumber = np.zeros(max(len(chroms), 1), dtype=np.int32)
+        renumber[order] = np.arange(len(chroms))
+        chroms = [chroms[i] for i in order]
+
+        columns = np.array([row[:4] + (row[5],) for row in rows], dtype=np.int64).reshape(-1, 5)
+        bits = np.array([row[4] for row in rows], dtype=np.uint64)
+        chrom = renumber[columns[:, 0]]
+        matechrom = renumber[columns[:, 2]]
+        idx = np.lexsort((columns[:, 4], columns[:, 1], chrom))
+
+        arrays = {'chrom': chrom[idx], 'pos': columns[idx, 1], 'matechrom': matechrom[idx],
+                  'matepos': columns[idx, 3], 'callerbits': bits[idx], 'offset': columns[idx, 4]}
+        arrays['mateorder'] = np.lexsort((arrays['matepos'], arrays['matechrom']))
+        return cls(os.path.abspath(filename), chroms, callers, arrays)
+
+    def save(self, directory):
+        """Write the index to directory as .npy files and meta.json"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for column in __columns__:
+            np.save(os.path.join(directory, column + '.npy'), np.asarray(getattr(self, column)))
+        meta = {'filename': self.filename, 'chroms': self.chroms, 'callers': self.callers,
+                'chromstarts': self.__chromstarts.tolist()}
+        with open(os.path.join(directory, 'meta.json'), 'w') as metafile:
+            json.dump(meta, metafile)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Load an index written by save(), memory-mapping the arrays by default"""
+        with open(os.path.join(directory, 'meta.json'), 'r') as metafile:
+            meta = json.load(metafile)
+        mode = 'r' if mmap else None
+        arrays = dict((column, np.load(os.path.join(directory, column + '.npy'), mmap_mode=mode))
+                      for column in __columns__)
+        arrays['chromstarts'] = meta['chromstarts']
+        return cls(meta['filename'], meta['chroms'], meta['callers'], arrays)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def callerMask(self, callers):
+        """Bitmask for a collection of caller names; unknown callers match nothing"""
+        mask = 0
+        for caller in callers:
+            if not caller in self.callers:
+                return None
+            mask |= 1 << self.callers.index(caller)
+        return np.uint64(mask)
+
+    def __filter(self, idx, callers, exact, mincallers):
+        if callers is not None:
+            mask = self.callerMask(callers)
+            if mask is None:
+                return idx[:0]
+            bits = np.asarray(self.callerbits)[idx]
+            idx = idx[(bits == mask) if exact else ((bits & mask) == mask)]
+        if mincallers > 1:
+            idx = idx[self.ncallers(idx) >= mincallers]
+        return idx
+
+    def ncallers(self, idx):
+        """Number of callers for each of the calls idx"""
+        bits = np.asarray(self.callerbits)[idx]
+        counts = np.zeros(len(bits), dtype=np.int32)
+        for i in range(len(self.callers)):
+            counts += ((bits >> np.uint64(i)) & np.uint64(1)).astype(np.int32)
+        return counts
+
+    def __range(self, starts, positions, order, chrom, start, end):
+        if not chrom in self.__chromids:
+            return np.zeros(0, dtype=np.int64)
+        cid = self.__chromids[chrom]
+        lo, hi = int(starts[cid]), int(starts[cid+1])
+        if order is None:
+            chrompos = positions[lo:hi]
+        else:
+            chrompos = positions[order[lo:hi]]
+        first = lo + np.searchsorted(chrompos, start, side='left')
+        last = lo + np.searchsorted(chrompos, end, side='right')
+        if order is None:
+            return np.arange(first, last)
+        return np.asarray(order[first:last])
+
+    def region(self, chrom, start, end, callers=None, exact=False, mincallers=0, mates=True):
+        """
+        Calls with a breakpoint in chrom:start-end (inclusive).  If callers
+        is given, only calls made by all of those callers (or exactly those,
+        if exact) are returned; if mates is False, only the call's first
+        position is considered.
+        """
+        idx = self.__range(self.__chromstarts, self.pos, None, chrom, start, end)
+        if mates:
+            mateidx = self.__range(self.__matestarts, self.matepos, self.mateorder, chrom, start, end)
+            idx = np.union1d(idx, mateidx)
+        return self.__filter(idx, callers, exact, mincallers)
+
+    def near(self, chrom, pos, window, **kwargs):
+        """Calls with a breakpoint within window of chrom:pos"""
+        return self.region(chrom, pos - window, pos + window, **kwargs)
+
+    def breakpoint(self, chrom1, pos1, chrom2, pos2, window, callers=None, exact=False, mincallers=0):
+        """Calls joining chrom1:pos1 and chrom2:pos2, each end within window, in either order"""
+        idx = self.__range(self.__chromstarts, self.pos, None, chrom1, pos1 - window, pos1 + window)
+        forward = idx[(np.asarray(self.matechrom)[idx] == self.__chromids.get(chrom2, -1)) &
+                      (np.abs(np.asarray(self.matepos)[idx] - pos2) <= window)]
+        idx = self.__range(self.__chromstarts, self.pos, None, chrom2, pos2 - window, pos2 + window)
+        reverse = idx[(np.asarray(self.matechrom)[idx] == self.__chromids.get(chrom1, -1)) &
+                      (np.abs(np.asarray(self.matepos)[idx] - pos1) <= window)]
+        return self.__filter(np.union1d(forward, reverse), callers, exact, mincallers)
+
+    def call(self, i):
+        """(chrom, pos, mate chrom, mate pos, callers) for call i"""
+        bits = int(self.callerbits[i])
+        return (self.chroms[np.searchsorted(self.__chromstarts, i, side='right') - 1], int(self.pos[i]),
+                self.chroms[int(self.matechrom[i])], int(self.matepos[i]),
+                [caller for j, caller in enumerate(self.callers) if bits & (1 << j)])
+
+    def lines(self, idx):
+        """The merged VCF record lines for the calls idx"""
+        with partition.openVCF(self.filename) as infile:
+            for i in idx:
+                infile.seek(int(self.offset[i]))
+                yield infile.readline()
@@ -0,0 +1,93 @@
+"""
+Spilling VCF records to temporary files partitioned by chromosome, so that
+a merge too big for memory can be done one partition at a time.  Variants
+whose first breakpoints are on different chromosomes are never merged
+together, so merging each partition separately gives the same clusters.
+"""
+import gzip
+import itertools
+import os
+import shutil
+import tempfile
+
+def openVCF(filename):
+    """Open a (possibly gzipped) VCF file for reading as text"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'r')
+    return open(filename, 'r')
+
+class linerecorder(object):
+    """
+    Iterates over the lines of a file, remembering the header lines and the
+    most recent line, so that the raw text of each record a vcf.Reader
+    parses from it is available.  offset and nlines are the bytes and lines
+    read so far.
+    """
+    def __init__(self, infile):
+        self.__infile = infile
+        self.header = []
+        self.line = None
+        self.offset = 0
+        self.nlines = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.__infile.readline()
+        if not line:
+            raise StopIteration()
+        if line.startswith('#'):
+            self.header.append(line)
+        self.line = line
+        self.offset += len(line)
+        self.nlines += 1
+        return line
+
+    def seek(self, offset, nlines):
+        """Continue reading from byte offset, the start of line nlines+1;
+        for gzipped files the offset is into the uncompressed text"""
+        self.__infile.seek(offset)
+        self.offset = offset
+        self.nlines = nlines
+
+class spillfiles(object):
+    """
+    Temporary files of raw VCF lines partitioned by key, remembering which
+    input each line came from.  Lines are read back in the order written.
+    """
+    def __init__(self, directory=None):
+        self.__dir = tempfile.mkdtemp(prefix='mergevcf-', dir=directory)
+        self.__filenames = {}
+        self.__files = {}
+        self.__counts = {}
+
+    def write(self, key, inputidx, line):
+        if not key in self.__files:
+            filename = os.path.join(self.__dir, "partition%d" % len(self.__filenames))
+            self.__filenames[key] = filename
+            self.__files[key] = open(filename, 'w')
+            self.__counts[key] = 0
+        self.__files[key].write("%d\t%s" % (inputidx, line))
+        self.__counts[key] += 1
+
+    def keys(self):
+        return self.__filenames.keys()
+
+    def count(self, key):
+        """Number of lines written to the partition"""
+        return self.__counts[key]
+
+    def read(self, key):
+        """Generates (inputidx, lines) for each run of lines from the same input"""
+        if key in self.__files:
+            self.__files.pop(key).close()
+        with open(self.__filenames[key], 'r') as infile:
+            for inputidx, lines in itertools.groupby(infile, lambda line: int(line.split('\t', 1)[0])):
+                yield inputidx, (line.split('\t', 1)[1] for line in lines)
+
+    def cleanup(self):
+        for spillfile in self.__files.values():
+            spillfile.close()
+        self.__files = {}
+        shutil.rmtree(self.__dir, ignore_errors=True)
@@ -0,0 +1,86 @@
+"""
+Low-overhead progress reports for long merges, as rate-limited JSON lines:
+records per second for the current input, bytes read against file size with
+an ETA, the number of clusters held, and resident memory.
+"""
+import json
+import os
+import time
+import mergevcf.memory as memory
+
+class progressreporter(object):
+    def __init__(self, stream, filenames, labels, interval=5.0):
+        self.__stream = stream
+        self.__interval = interval
+        self.__labels = labels
+        self.__sizes = [self.__filesize(f) for f in filenames]
+        self.__start = time.time()
+        self.__lastreport = 0.
+        self.__input = None
+        self.__phase = 'ingest'
+
+    @staticmethod
+    def __filesize(filename):
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def startInput(self, idx, infile, phase='ingest'):
+        """Start reporting on input idx, being read from the open file infile"""
+        self.__input = idx
+        self.__phase = phase
+        self.__infile = infile
+        self.__inputstart = time.time()
+        self.__records = 0
+        self.__offset = None
+
+    def update(self, nrecords, nclusters, position=None):
+        """Note that nrecords more records have been read from the current
+        input, up to byte position if given rather than the file position;
+        report if it's been long enough since the last report"""
+        self.__records += nrecords
+        if position is not None:
+            self.__offset = position
+        if time.time() - self.__lastreport >= self.__interval:
+            self.report(nclusters)
+
+    def finishInput(self, nclusters):
+        self.report(nclusters)
+        self.__input = None
+
+    def __position(self):
+        """Bytes of the current input consumed so far"""
+        if self.__offset is not None:
+            return self.__offset
+        try:
+            return os.lseek(self.__infile.fileno(), 0, os.SEEK_CUR)
+        except (AttributeError, OSError, ValueError):
+            return 0
+
+    def report(self, nclusters, phase=None):
+        now = time.time()
+        self.__lastreport = now
+        if phase is not None:
+            self.__phase = phase
+        entry = {'time': now, 'elapsed': now - self.__start, 'phase': self.__phase,
+                 'clusters': nclusters, 'rss': memory.currentRSS()}
+
+        idx = self.__input
+        if idx is not None:
+            size = self.__sizes[idx]
+            position = min(self.__position(), size)
+            elapsed = now - self.__inputstart
+            entry.update({'input': self.__labels[idx], 'input_index': idx, 'ninputs': len(self.__labels),
+                          'records': self.__records,
+                          'records_per_second': self.__records / elapsed if elapsed > 0 else 0.,
+                          'bytes_read': position, 'bytes_total': size})
+
+            done = sum(self.__sizes[:idx]) + position
+            total = sum(self.__sizes)
+            if done > 0 and total > 0:
+                entry['fraction'] = done / float(total)
+                entry['eta_seconds'] = (now - self.__start) * (total - done) / float(done)
+
+        self.__stream.write(json.dumps(entry, sort_keys=True) + "\n")
+        self.__stream.flush()
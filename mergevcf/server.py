@@ -0,0 +1,151 @@
+"""
+A persistent merge server, so that many small merges don't each pay for
+interpreter startup and imports.  The server listens on a local Unix socket
+for merge jobs, one JSON object per line, runs them on a pool of worker
+processes, and replies to each with one JSON line of per-job statistics.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import SocketServer
+import stat
+import tempfile
+import threading
+import mergevcf.jobs as jobs
+
+def defaultSocketPath():
+    return os.path.join(tempfile.gettempdir(), "mergevcf-%d.sock" % os.getuid())
+
+def _ignoreInterrupts():
+    """Worker processes leave SIGINT handling to the server"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class _jobhandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.respond(line)
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class mergeserver(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketpath, nworkers=None):
+        """Listen on socketpath, replacing a stale socket there but not
+        one a server is still answering on, nor anything but a socket"""
+        if os.path.lexists(socketpath):
+            if not stat.S_ISSOCK(os.lstat(socketpath).st_mode):
+                raise socket.error(socketpath + " exists and is not a socket")
+            try:
+                submit({'command': 'ping'}, socketpath)
+            except (socket.error, ValueError):
+                os.remove(socketpath)
+            else:
+                raise socket.error("A merge server is already listening at " + socketpath)
+        self.socketpath = socketpath
+        self.pool = None
+        SocketServer.UnixStreamServer.__init__(self, socketpath, _jobhandler)
+        self.pool = multiprocessing.Pool(nworkers, _ignoreInterrupts)
+
+    def server_bind(self):
+        """Bind the socket so only this user can connect; jobs read and
+        write files as the server's user"""
+        oldmask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(oldmask)
+        os.chmod(self.socketpath, 0o600)
+
+    def respond(self, line):
+        """Reply (as a dictionary) to a single JSON request line"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {'status': 'error', 'error': 'Invalid request: ' + str(e)}
+
+        command = request.get('command', 'merge')
+        if command == 'ping':
+            return {'status': 'ok'}
+        if command == 'shutdown':
+            # shutdown() waits for serve_forever to exit, so can't run on this thread
+            stopper = threading.Thread(target=self.shutdown)
+            stopper.start()
+            return {'status': 'ok'}
+        if command != 'merge':
+            return {'status': 'error', 'error': 'Unknown command: ' + str(command)}
+
+        try:
+            stats = self.pool.apply(jobs.runJob, (request,))
+        except Exception as e:
+            return {'status': 'error', 'error': '%s: %s' % (type(e).__name__, str(e))}
+        return {'status': 'ok', 'stats': stats}
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        if os.path.exists(self.socketpath):
+            os.remove(self.socketpath)
+
+def serve(socketpath, nworkers=None):
+    """Run a merge server on socketpath until interrupted or shut down"""
+    server = mergeserver(socketpath, nworkers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def submit(job, socketpath):
+    """Submit a job to the server at socketpath and return its reply.
+    Raises socket.error if there's no server listening."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath)
+        sockfile = sock.makefile('rw')
+        sockfile.write(json.dumps(job) + "\n")
+        sockfile.flush()
+        reply = sockfile.readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise socket.error("No reply from merge server at " + socketpath)
+    return json.loads(reply)
+
+def submitOrRun(job, socketpath):
+    """Submit a job to the server if one is running, otherwise run it in
+    this process.  Returns the job statistics."""
+    try:
+        reply = submit(job, socketpath)
+    except socket.error:
+        return jobs.runJob(job)
+    if reply['status'] != 'ok':
+        raise RuntimeError(reply['error'])
+    return reply['stats']
+
+def serveMain(argv):
+    """Entry point for mergevcf serve"""
+    parser = argparse.ArgumentParser(prog='mergevcf serve', description='Run a persistent merge server')
+    parser.add_argument('--socket', type=str, default=defaultSocketPath(), help='Unix socket to listen on (default:'+defaultSocketPath()+')')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes (default:number of CPUs)')
+    args = parser.parse_args(argv)
+    serve(args.socket, args.workers)
+
+def submitMain(argv):
+    """Entry point for mergevcf submit"""
+    parser = argparse.ArgumentParser(prog='mergevcf submit', description='Submit a merge to a merge server, or run it here if none is running')
+    jobs.addMergeArguments(parser, outputAsPath=True)
+    parser.add_argument('--socket', type=str, default=defaultSocketPath(), help='Unix socket of the server (default:'+defaultSocketPath()+')')
+    args = parser.parse_args(argv)
+    stats = submitOrRun(jobs.jobFromArgs(args), args.socket)
+    if args.stats is not None:
+        with open(args.stats, 'w') as statsfile:
+            json.dump(stats, statsfile, indent=2)
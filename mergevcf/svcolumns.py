@@ -0,0 +1,160 @@
+"""
+Columnar normalization of symbolic SV records (<DEL>, <DUP>, <INV>, <INS>)
+into breakpoint pairs with NumPy.  This follows the same expansion rules as
+vcftobreakpoints.breakpointsFromRecord, which is still used for breakends
+and anything unusual.  Requires numpy.
+"""
+import collections
+import vcf
+import mergevcf.locations as loc
+import mergevcf.vcftobreakpoints as svvcf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# SV type codes
+OTHER, DEL, DUP, INV, INS = 0, 1, 2, 3, 4
+svtypecodes = {'DEL': DEL, 'DEL:ME:ALU': DEL, 'DUP': DUP, 'DUP:TANDEM': DUP,
+               'INV': INV, 'INS': INS, 'INS:ME:L1': INS}
+
+# connection type (CT) codes
+CT_NONE, CT_3TO5, CT_5TO3, CT_5TO5, CT_3TO3, CT_OTHER = 0, 1, 2, 3, 4, 5
+ctcodes = {None: CT_NONE, '3to5': CT_3TO5, '5to3': CT_5TO3, '5to5': CT_5TO5, '3to3': CT_3TO3}
+
+# Pairs of breakpoints, one row per pair: the row of the input record,
+# chromosome id, and position, strand (True for +) and extent (True if
+# extending right) of the two ordered breakpoints
+breakpointarrays = collections.namedtuple('breakpointarrays',
+        ['row', 'chrom', 'pos1', 'strand1', 'right1', 'pos2', 'strand2', 'right2'])
+
+def available():
+    return np is not None
+
+def symbolicBreakpoints(chroms, pos, end, svtypes, cts):
+    """
+    Normalize columns of intrachromosomal symbolic SVs - chromosome id,
+    POS, END (negative if missing), SV type code and CT code - into ordered
+    breakpoint pairs.  Returns (breakpointarrays sorted by input row,
+    boolean array of rows which must go through the scalar path instead).
+    """
+    chroms = np.asarray(chroms, dtype=np.int64)
+    pos = np.asarray(pos, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    svtypes = np.asarray(svtypes, dtype=np.int8)
+    cts = np.asarray(cts, dtype=np.int8)
+    n = len(pos)
+
+    fallback = (svtypes == OTHER) | (cts == CT_OTHER) | ((end < 0) & (svtypes != INS))
+    rows = np.arange(n)
+    ok = ~fallback
+
+    def pairs(mask, p1, s1, r1, p2, s2, r2, sub=0):
+        """Columns of the pairs for the selected rows, with constant strands
+        and extents; sub orders multiple pairs from the same row"""
+        sel = np.nonzero(mask)[0]
+        size = len(sel)
+        return (rows[sel]*2 + sub, chroms[sel], p1[sel], np.full(size, s1, dtype=bool), np.full(size, r1, dtype=bool),
+                p2[sel], np.full(size, s2, dtype=bool), np.full(size, r2, dtype=bool))
+
+    low, high = np.minimum(pos, end), np.maximum(pos, end)
+    parts = []
+
+    # deletions: translocation(min, max, 3to5)
+    parts.append(pairs(ok & (svtypes == DEL), low, True, False, high, True, True))
+
+    # duplications: ordered 5to3 if CT is absent or 5to3/3to5, otherwise as given
+    dup = ok & (svtypes == DUP)
+    parts.append(pairs(dup & (cts <= CT_5TO3), low, True, True, high, True, False))
+    parts.append(pairs(dup & (cts == CT_5TO5), pos, True, True, end, False, True))
+    parts.append(pairs(dup & (cts == CT_3TO3), pos, True, False, end, False, False))
+
+    # inversions: two pairs, 3to3 then 5to5
+    inv = ok & (svtypes == INV)
+    parts.append(pairs(inv, pos, True, False, end-1, False, False, sub=0))
+    parts.append(pairs(inv, pos+1, True, True, end, False, True, sub=1))
+
+    # insertions: the position and the following base
+    parts.append(pairs(ok & (svtypes == INS), pos, True, False, pos+1, True, True))
+
+    order, chrom, p1, s1, r1, p2, s2, r2 = [np.concatenate(column) for column in zip(*parts)]
+
+    # order breakpoints as orderBreakpoints does: swap unless the first is
+    # before the second, then if the new first is on the reverse strand,
+    # reverse both
+    swap = ~(p1 < p2)
+    p1, p2 = np.where(swap, p2, p1), np.where(swap, p1, p2)
+    s1, s2 = np.where(swap, s2, s1), np.where(swap, s1, s2)
+    r1, r2 = np.where(swap, r2, r1), np.where(swap, r1, r2)
+    flip = swap & ~s1
+    s1 = np.where(flip, ~s1, s1)
+    s2 = np.where(flip, ~s2, s2)
+
+    idx = np.argsort(order, kind='mergesort')
+    result = breakpointarrays(order[idx] // 2, chrom[idx], p1[idx], s1[idx], r1[idx],
+                              p2[idx], s2[idx], r2[idx])
+    return result, fallback
+
+def _symboliccolumns(record):
+    """(chrom, pos, end, svtype code, CT code) for a record that may take
+    the columnar path, or None if it must take the scalar path"""
+    if record.ALT is None or len(record.ALT) != 1 or type(record.ALT[0]) is not vcf.model._SV:
+        return None
+    svtype = svtypecodes.get(record.ALT[0].type, OTHER)
+    if svtype == OTHER:
+        return None
+
+    svvcf.setupREs()
+    if svvcf.__looseendRE__.search(str(record.FILTER)):
+        return None
+
+    chr1 = svvcf.stdchrom(record.CHROM)
+    chr2, end, ct, _, _ = svvcf.otherPosnSymbolic(record.INFO)
+    if chr2 is not None and chr2 != chr1:
+        return None
+    if end is None:
+        end = -1
+    try:
+        end = int(end)
+    except (TypeError, ValueError):
+        return None
+    return chr1, int(record.POS), end, svtype, ctcodes.get(ct, CT_OTHER)
+
+def breakpointsFromRecords(records):
+    """
+    Returns a list with the list of breakpoint pairs for each record, the
+    same as breakpointsFromRecord for each; symbolic SVs are normalized
+    together in columns.
+    """
+    results = [None] * len(records)
+    columnrows = []
+    columns = []
+    for i, record in enumerate(records):
+        cols = _symboliccolumns(record)
+        if cols is None:
+            results[i] = svvcf.breakpointsFromRecord(record)
+        else:
+            columnrows.append(i)
+            columns.append(cols)
+
+    if columns:
+        chromnames = []
+        chromids = {}
+        for cols in columns:
+            if not cols[0] in chromids:
+                chromids[cols[0]] = len(chromnames)
+                chromnames.append(cols[0])
+
+        chroms, pos, end, svtypes, cts = zip(*columns)
+        bkpts, fallback = symbolicBreakpoints([chromids[c] for c in chroms], pos, end, svtypes, cts)
+
+        for j in np.nonzero(fallback)[0]:
+            results[columnrows[j]] = svvcf.breakpointsFromRecord(records[columnrows[j]])
+        for j in np.nonzero(~fallback)[0]:
+            results[columnrows[j]] = []
+        for j, chrom, p1, s1, r1, p2, s2, r2 in zip(*[column.tolist() for column in bkpts]):
+            chromname = chromnames[chrom]
+            results[columnrows[j]].append((loc.location(chromname, p1, s1, r1),
+                                           loc.location(chromname, p2, s2, r2)))
+    return results
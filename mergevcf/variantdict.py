@@ -1,9 +1,13 @@
 """
 Definitions for a dictionary of variants, and operations on them
 """
-from mergevcf.locations import locationdict, location
+from mergevcf.locations import locationdict, location, _windowgroups
+import array
+import functools
+import random
 import vcf
 import mergevcf.vcftobreakpoints as svvcf
+import mergevcf.svcolumns as svcolumns
 
 def __checkvalidpairlocs__(t):
     """
@@ -17,10 +21,98 @@ def __checkvalidpairlocs__(t):
         return True
     return False
 
+def normalizedVariants(record, forceSV=False):
+    """
+    Returns the list of variant tuples for a record: (location, location)
+    breakpoint pairs for SVs, or (location, (ref, alt)) for other variants
+    """
+    assert type(record) is vcf.model._Record
+
+    if isSV(record, forceSV):
+        return svvcf.breakpointsFromRecord(record)
+    return __allelevariants__(record)
+
+def normalizedVariantsBatch(records, forceSV=False):
+    """
+    Returns the normalizedVariants of each of a list of records; if numpy
+    is available, symbolic SVs are normalized together in columns
+    """
+    if not svcolumns.available():
+        return [normalizedVariants(record, forceSV) for record in records]
+
+    svrows = [i for i, record in enumerate(records) if isSV(record, forceSV)]
+    results = [None] * len(records)
+    for i, pairs in zip(svrows, svcolumns.breakpointsFromRecords([records[i] for i in svrows])):
+        results[i] = pairs
+    for i, record in enumerate(records):
+        if results[i] is None:
+            results[i] = __allelevariants__(record)
+    return results
+
+def isSV(record, forceSV=False):
+    """Is the record to be treated as an SV (as breakpoint pairs)?"""
+    return forceSV or (record.ALT is not None and len(record.ALT) > 0 and type(record.ALT[0]) in [vcf.model._SV, vcf.model._Breakend])
+
+def __allelevariants__(record):
+    variants = []
+    for alt in record.ALT:
+        if alt is None:
+            continue
+        loc = location(record.CHROM, int(record.POS))
+        allele = (record.REF, str(alt))
+        variants.append((loc, allele))
+    return variants
+
+def partitionKey(vartuple):
+    """
+    The chromosome of a variant tuple's first location; variants with
+    different keys can never be merged together, or affect each other's
+    clusters, since SV clusters are keyed by their first breakpoint
+    """
+    return vartuple[0].chrom
+
+class reservoir(list):
+    """
+    A uniform random sample of at most size of the items appended to it,
+    kept by reservoir sampling; seen is the number appended in total
+    """
+    def __init__(self, items, size, rng):
+        super(reservoir, self).__init__(items[:size])
+        self.size = size
+        self.seen = len(items)
+        self.__rng = rng
+
+    def append(self, item):
+        self.seen += 1
+        if len(self) < self.size:
+            super(reservoir, self).append(item)
+            return
+        i = self.__rng.randrange(self.seen)
+        if i < self.size:
+            self[i] = item
+
+class callercounts(dict):
+    """Exact counts of the callers appended to it; iterates over the
+    distinct callers, so can stand in for a list of callers"""
+    def __init__(self, callers=()):
+        super(callercounts, self).__init__()
+        for caller in callers:
+            self.append(caller)
+
+    def append(self, caller):
+        self[caller] = self.get(caller, 0) + 1
+
 class locationpairdict(object):
-    def __init__(self, window):
+    def __init__(self, window, limit=None, summary=None):
+        """
+        If limit is given, once a location pair has limit entries its list
+        is replaced by summary(entries), which is then appended to instead
+        """
         self.__window = window
         self.__lpdict = locationdict(self.__window)
+        self.__nentries = 0
+        self.__limit = limit
+        self.__summary = summary
 
     def __contains__(self, lpair):
         if not __checkvalidpairlocs__(lpair):
@@ -51,24 +143,202 @@ class locationpairdict(object):
             self.__lpdict[locn1] = locationdict(self.__window)
         if not locn2 in self.__lpdict[locn1]:
             self.__lpdict[locn1][locn2] = []
-        self.__lpdict[locn1][locn2].append(entry)
+            self.__nentries += 1
+        entries = self.__lpdict[locn1][locn2]
+        if self.__limit is not None and type(entries) is list and len(entries) >= self.__limit:
+            entries = self.__summarize(locn1, locn2, entries)
+        entries.append(entry)
+
+    def __delitem__(self, lpair):
+        """Remove a location pair, and its first location once it has no others"""
+        if not self.__contains__(lpair):
+            raise KeyError("Not in location pair dicti")
+        locn1 = lpair[0]; locn2 = lpair[1]
+        seconds = self.__lpdict[locn1]
+        del seconds[locn2]
+        self.__nentries -= 1
+        if len(seconds) == 0:
+            del self.__lpdict[locn1]
+
+    def __summarize(self, locn1, locn2, entries):
+        """Replace the entries for a location pair with their summary"""
+        seconds = self.__lpdict[locn1]
+        present, foundoff = seconds.__find__(locn2)
+        summary = self.__summary(entries)
+        dict.__setitem__(seconds, locn2 + foundoff, summary)
+        return summary
+
+    @classmethod
+    def fromsorted(cls, window, chrom1, pos1, strand1, extent1,
+                   chrom2, pos2, strand2, extent2, payloads):
+        """
+        Build a locationpairdict from columns of location pairs and
+        payloads, sorted by first position within each chromosome.  The
+        first locations are grouped in one linear pass; the lookups are the
+        same as for setting each row in order.
+        """
+        lpd = cls(window)
+        if len(set(len(column) for column in [chrom1, chrom2, pos2, strand2, extent2, payloads])) != 1:
+            raise ValueError("Columns must all be the same length")
+        pairs = zip(chrom2, pos2, strand2, extent2, payloads)
+        for locn1, group in _windowgroups(window, chrom1, pos1, strand1, extent1, pairs):
+            seconds = locationdict(window)
+            for _, (chrom, pos, strand, extent, payload) in group:
+                locn2 = location(chrom, int(pos), strand, bool(extent))
+                if not locn2 in seconds:
+                    seconds[locn2] = []
+                    lpd.__nentries += 1
+                seconds[locn2].append(payload)
+            lpd.__lpdict[locn1] = seconds
+        return lpd
 
     def keys(self):
         return self.__lpdict.keys()
 
+    def __len__(self):
+        """Number of distinct location pairs"""
+        return self.__nentries
+
     def __iter__(self):
         return self.__lpdict.__iter__()
 
+class smallvariantstore(object):
+    """
+    Small variants at exact positions, stored by column: each distinct
+    (chromosome, position, ref, alt), in order of first appearance, has a
+    row of chromosome id, position, interned allele id and a bitmask of
+    its callers.  Rows are looked up by a single packed integer key.
+    Callers are listed in the order given, then in the order they were
+    first added to the store.
+    """
+    def __init__(self, callers=()):
+        self.__chromnames, self.__chromids = [], {}
+        self.__alleles, self.__alleleids = [], {}
+        self.__callers, self.__callerbits = [], {}
+        for caller in callers:
+            self.__callerbit(caller)
+        self.__rows = {}
+        self.__chrom = array.array('i')
+        self.__pos = array.array('l')
+        self.__allele = array.array('l')
+        self.__callermasks = []
+
+    def __key(self, chrom, pos, allele, create=False):
+        chromid = self.__chromids.get(chrom)
+        alleleid = self.__alleleids.get(allele)
+        if chromid is None or alleleid is None:
+            if not create:
+                return None
+            if chromid is None:
+                chromid = self.__chromids[chrom] = len(self.__chromnames)
+                self.__chromnames.append(chrom)
+            if alleleid is None:
+                alleleid = self.__alleleids[allele] = len(self.__alleles)
+                self.__alleles.append(allele)
+        return self.__packed(chromid, pos, alleleid), chromid, alleleid
+
+    @staticmethod
+    def __packed(chromid, pos, alleleid):
+        return (((chromid << 32) | pos) << 32) | alleleid
+
+    def add(self, chrom, pos, allele, caller):
+        """Add caller's call of allele (ref, alt) at chrom:pos"""
+        key, chromid, alleleid = self.__key(chrom, pos, allele, create=True)
+        bit = self.__callerbit(caller)
+        row = self.__rows.get(key)
+        if row is None:
+            row = self.__rows[key] = len(self.__pos)
+            self.__chrom.append(chromid)
+            self.__pos.append(pos)
+            self.__allele.append(alleleid)
+            self.__callermasks.append(0)
+        self.__callermasks[row] |= bit
+
+    def __callerbit(self, caller):
+        bit = self.__callerbits.get(caller)
+        if bit is None:
+            bit = self.__callerbits[caller] = 1 << len(self.__callers)
+            self.__callers.append(caller)
+        return bit
+
+    def __row(self, chrom, pos, allele):
+        key = self.__key(chrom, pos, allele)
+        if key is None:
+            return None
+        return self.__rows.get(key[0])
+
+    def __contains__(self, variant):
+        chrom, pos, allele = variant
+        return self.__row(chrom, pos, allele) is not None
+
+    def __callerlist(self, mask):
+        return [caller for i, caller in enumerate(self.__callers) if mask & (1 << i)]
+
+    def callers(self, chrom, pos, allele):
+        row = self.__row(chrom, pos, allele)
+        if row is None:
+            raise KeyError("%s:%d %s" % (chrom, pos, allele))
+        return self.__callerlist(self.__callermasks[row])
+
+    def __len__(self):
+        return len(self.__pos)
+
+    def __iter__(self):
+        """Generates (chrom, pos, (ref, alt), callers) in order of first appearance"""
+        chromnames, alleles = self.__chromnames, self.__alleles
+        for chromid, pos, alleleid, mask in zip(self.__chrom, self.__pos, self.__allele, self.__callermasks):
+            yield chromnames[chromid], pos, alleles[alleleid], self.__callerlist(mask)
+
+    def pop(self, closed):
+        """Remove the rows at positions where closed(chrom, pos), returning
+        them as iteration would; the other rows keep their order"""
+        chromnames, alleles = self.__chromnames, self.__alleles
+        rows = zip(self.__chrom, self.__pos, self.__allele, self.__callermasks)
+        popped = [row for row in rows if closed(chromnames[row[0]], row[1])]
+        if not popped:
+            return []
+        kept = [row for row in rows if not closed(chromnames[row[0]], row[1])]
+
+        self.__rows = {}
+        self.__chrom = array.array('i')
+        self.__pos = array.array('l')
+        self.__allele = array.array('l')
+        self.__callermasks = []
+        for chromid, pos, alleleid, mask in kept:
+            self.__rows[self.__packed(chromid, pos, alleleid)] = len(self.__pos)
+            self.__chrom.append(chromid)
+            self.__pos.append(pos)
+            self.__allele.append(alleleid)
+            self.__callermasks.append(mask)
+        return [(chromnames[chromid], pos, alleles[alleleid], self.__callerlist(mask))
+                for chromid, pos, alleleid, mask in popped]
+
 class variantmap(object):
-    def __init__(self, awindow, svwindow):
+    def __init__(self, awindow, svwindow, hotspotlimit=None, seed=0, callers=()):
+        """
+        If hotspotlimit is given, SV clusters with more than that many
+        records are summarized: their callers by exact counts, and their
+        positions and records by a seeded reservoir sample of that size.
+        Exact small variants list their callers in the order of callers,
+        if given, before any others.
+        """
         self.__awindow = awindow
         self.__svwindow = svwindow
 
-        self.__alleledict = locationdict(awindow)     # map locn -> allele (ref/alt)
-        self.__svdict = locationpairdict(svwindow)    # map locn -> locn (for SVs - paired breakpoints)
-        self.__locn1pos = locationpairdict(svwindow)  # map locn -> all the locations found which map to this one 
-        self.__locn2pos = locationpairdict(svwindow)  # map locn -> all the locations found which map to this one 
-        self.__records = locationpairdict(svwindow)   # all the records involving this location
+        sample = None
+        if hotspotlimit is not None:
+            sample = functools.partial(reservoir, size=hotspotlimit, rng=random.Random(seed))
+
+        self.__alleledict = None                      # map locn -> allele (ref/alt), if windowed
+        self.__smallvariants = None                   # exact-position small variants
+        if awindow == 0:
+            self.__smallvariants = smallvariantstore(callers)
+        else:
+            self.__alleledict = locationdict(awindow)
+        self.__svdict = locationpairdict(svwindow, hotspotlimit, callercounts)    # map locn -> locn (for SVs - paired breakpoints)
+        # (pos1, pos2, (caller, record)) of each record in a pair's cluster, sampled together
+        self.__members = locationpairdict(svwindow, hotspotlimit, sample)
+        self.__nalleles = 0
 
     def __medianpos__(self, locn1, locn2):
         def median(l):
@@ -81,14 +351,15 @@ class variantmap(object):
 
         if not (locn1, locn2) in self.__svdict:
             return None, None
-        posn1s = self.__locn1pos[(locn1, locn2)]
-        posn2s = self.__locn2pos[(locn1, locn2)]
-        return median(posn1s), median(posn2s)
+        members = self.__members[(locn1, locn2)]
+        return median([m[0] for m in members]), median([m[1] for m in members])
 
     def __svpresent__(self, locn1, locn2):
         return (locn1, locn2) in self.__svdict
 
     def __allelepresent__(self, locn, allele):
+        if self.__smallvariants is not None:
+            return (locn.__chrom__, locn.__pos__, allele) in self.__smallvariants
         if not locn in self.__alleledict:
             return False
         return allele in self.__alleledict[locn]
@@ -97,13 +368,23 @@ class variantmap(object):
         self.__svdict[(locn1, locn2)] = caller
 
     def __addallelecaller__(self, locn, allele, caller):
+        if self.__smallvariants is not None:
+            self.__smallvariants.add(locn.__chrom__, locn.__pos__, allele, caller)
+            return
         if not locn in self.__alleledict:
             self.__alleledict[locn] = {}
         if not allele in self.__alleledict[locn]:
             self.__alleledict[locn][allele] = []
+            self.__nalleles += 1
         if not caller in self.__alleledict[locn][allele]:
             self.__alleledict[locn][allele].append(caller)
 
+    def nclusters(self):
+        """Number of distinct variants (alleles or breakpoint pairs) held"""
+        if self.__smallvariants is not None:
+            return len(self.__smallvariants) + len(self.__svdict)
+        return self.__nalleles + len(self.__svdict)
+
     def __contains__(self, vartuple):
         assert type(vartuple) is tuple or type(vartuple) is list
         assert len(vartuple) > 1
@@ -125,9 +406,7 @@ class variantmap(object):
             other = location(None,0)
         if type(other) is location:
             self.__addsvcaller__(locn, other, caller)
-            self.__locn1pos[(locn,other)] = locn.__pos__
-            self.__locn2pos[(locn,other)] = other.__pos__
-            self.__records[(locn,other)] = (caller, record)
+            self.__members[(locn,other)] = (locn.__pos__, other.__pos__, (caller, record))
         else:
             self.__addallelecaller__(locn, other, caller)
 
@@ -141,18 +420,17 @@ class variantmap(object):
             other = vartuple[1]
             if type(other) is location:
                 return self.__svdict[locn][other]
+            elif self.__smallvariants is not None:
+                return self.__smallvariants.callers(locn.__chrom__, locn.__pos__, other)
             else:
                 return self.__alleledict[locn][other]
 
     def __str__(self):
         output=""
-        for loc in self.__alleledict:
-            chrom = loc.__chrom__
-            pos = loc.__pos__
-            for item in self.__alleledict[loc]:
-                ref, alt = item
-                output+="\t".join([chrom, str(pos), '.', ref, alt])
-                output+="\tCallers="+",".join(self.__alleledict[loc][item])+"\n"
+        for loc, item, callers in self.__alleles__():
+            ref, alt = item
+            output+="\t".join([loc.__chrom__, str(loc.__pos__), '.', ref, alt])
+            output+="\tCallers="+",".join(callers)+"\n"
 
         for loc1 in self.__svdict:
             chrom1 = loc1.__chrom__
@@ -168,29 +446,89 @@ class variantmap(object):
 
     # forceSV is here to allow forcing a call that looks like a huge indel to be treated as an SV
     def addrecord(self, record, caller="NA", forceSV=False):
-        assert type(record) is vcf.model._Record
-
-        if forceSV or (record.ALT is not None and len(record.ALT) > 0 and type(record.ALT[0]) in [vcf.model._SV, vcf.model._Breakend]):
-            bkptPairs = svvcf.breakpointsFromRecord(record)
-            for pair in bkptPairs:
-                self.__setitem__(pair, caller, record)
-        else: 
-            for alt in record.ALT:
-                if alt is None:
-                    continue
-                loc = location(record.CHROM, int(record.POS))
-                allele = (record.REF, str(alt))
-                self.__setitem__((loc, allele), caller)
+        self.addnormalized(normalizedVariants(record, forceSV), caller, record)
 
-    def __iter__(self):
-        def generatorIterator():
-            for loc in self.__alleledict:
-                for allele in self.__alleledict[loc]:
-                    yield loc, allele, self.__alleledict[loc][allele]
-            for loc1 in self.__svdict:
-                for loc2 in self.__svdict[loc1]:
+    def addrecords(self, records, caller="NA", forceSV=False):
+        """Add a list of records.  If one can't be added, the records before
+        it still are, and the exception is raised with the index of the one
+        that failed as its recordindex."""
+        try:
+            normalized = normalizedVariantsBatch(records, forceSV)
+        except Exception:
+            normalized = None
+        for i, record in enumerate(records):
+            try:
+                if normalized is None:
+                    self.addrecord(record, caller, forceSV)
+                else:
+                    self.addnormalized(normalized[i], caller, record)
+            except Exception as err:
+                err.recordindex = i
+                raise
+
+    def __alleles__(self, closed=None):
+        """Generates (location, allele, callers) for the small variants;
+        with closed, only those at locations where closed(location), which
+        are removed"""
+        if self.__smallvariants is not None:
+            if closed is None:
+                variants = self.__smallvariants
+            else:
+                variants = self.__smallvariants.pop(lambda chrom, pos: closed(location(chrom, pos)))
+            for chrom, pos, allele, callers in variants:
+                yield location(chrom, pos), allele, callers
+            return
+        for loc in self.__alleledict.keys():
+            if closed is not None and not closed(loc):
+                continue
+            alleles = self.__alleledict[loc]
+            if closed is not None:
+                dict.__delitem__(self.__alleledict, loc)
+                self.__nalleles -= len(alleles)
+            for allele in alleles:
+                yield loc, allele, alleles[allele]
+
+    def __records__(self, locn1, locn2):
+        """The (caller, record)s of a pair's cluster; a reservoir if sampled"""
+        members = self.__members[(locn1, locn2)]
+        records = [m[2] for m in members]
+        if isinstance(members, reservoir):
+            records = reservoir(records, members.size, None)
+            records.seen = members.seen
+        return records
+
+    def __removesv__(self, locn1, locn2):
+        for lpdict in [self.__svdict, self.__members]:
+            del lpdict[(locn1, locn2)]
+
+    def addnormalized(self, variants, caller="NA", record=None):
+        """Add the variant tuples normalized from a record"""
+        for vartuple in variants:
+            self.__setitem__(vartuple, caller, record)
+
+    def variants(self, mincallers=0, closed=None):
+        """
+        Generates the variants as iteration does, skipping those called by
+        fewer than mincallers distinct callers before their positions are
+        summarized.  If closed is given, only variants with both locations
+        closed(location) - those no later record can join - are generated,
+        and they (and the skipped ones) are removed.
+        """
+        for loc, allele, callers in self.__alleles__(closed):
+            if len(set(callers)) >= mincallers:
+                yield loc, allele, callers
+        for loc1 in self.__svdict.keys():
+            if closed is not None and not closed(loc1):
+                continue
+            for loc2 in self.__svdict[loc1].keys():
+                if closed is not None and not closed(loc2):
+                    continue
+                callers = self.__svdict[loc1][loc2]
+                if len(set(callers)) >= mincallers:
                     pos1, pos2 = self.__medianpos__(loc1, loc2)
-                    yield loc1, loc2, self.__svdict[loc1][loc2], pos1, pos2, self.__records[(loc1,loc2)]
-            raise StopIteration()
+                    yield loc1, loc2, callers, pos1, pos2, self.__records__(loc1, loc2)
+                if closed is not None:
+                    self.__removesv__(loc1, loc2)
 
-        return generatorIterator()
+    def __iter__(self):
+        return self.variants()
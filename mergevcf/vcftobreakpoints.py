@@ -25,6 +25,13 @@ def stdchrom(chrom):
     else:
         return chrom
 
+def chromSortKey(chrom):
+    """Sort numbered chromosomes numerically, before the others"""
+    try:
+        return (0, int(chrom), '')
+    except ValueError:
+        return (1, 0, chrom)
+
 def orderBreakpoints(loc1, loc2):
     # already ordered?  Just return them
     if loc1 < loc2:
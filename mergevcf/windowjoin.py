@@ -0,0 +1,151 @@
+"""
+Matching breakpoint pairs across callers with sorted arrays rather than
+dictionary state: each caller's pairs are sorted by (chromosome pair,
+orientation, first position), and all pairs within the window at both ends
+are found with searchsorted range queries.  Requires numpy.
+"""
+import argparse
+import collections
+import itertools
+import sys
+import vcf
+import mergevcf.jobs as jobs
+import mergevcf.mergedfile as mergedfile
+import mergevcf.partition as partition
+import mergevcf.variantdict as variantdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Breakpoint pairs as columns: row is the index of the pair in the list it
+# was made from; chromosomes are ids from a shared chromosome dictionary
+pairarrays = collections.namedtuple('pairarrays',
+        ['row', 'chrom1', 'pos1', 'strand1', 'right1', 'chrom2', 'pos2', 'strand2', 'right2'])
+
+# how many rows to match at once, bounding the candidate arrays
+__chunksize__ = 1 << 16
+
+# group keys and positions are packed into one int64 each
+__maxchroms__ = 1 << 13
+
+def pairArrays(pairs, chromids):
+    """
+    Columns for a list of (location, location) breakpoint pairs; chromids
+    is a dictionary of chromosome name -> id, updated with new chromosomes
+    """
+    def chromid(chrom):
+        if not chrom in chromids:
+            chromids[chrom] = len(chromids)
+        return chromids[chrom]
+
+    columns = [[chromid(l1.chrom), l1.pos, l1.__strand__, l1.__right__,
+                chromid(l2.chrom), l2.pos, l2.__strand__, l2.__right__] for l1, l2 in pairs]
+    if not columns:
+        columns = np.zeros((0, 8), dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64).reshape(-1, 8)
+    return pairarrays(np.arange(len(columns)), *[columns[:, i] for i in range(8)])
+
+def __groupkeys__(arrays, nchroms):
+    """An integer for each pair's (chrom1, chrom2, orientation), shifted to
+    leave room for the first position"""
+    orientation = (arrays.strand1.astype(np.int64) << 3) | (arrays.right1.astype(np.int64) << 2) | \
+                  (arrays.strand2.astype(np.int64) << 1) | arrays.right2.astype(np.int64)
+    return ((arrays.chrom1.astype(np.int64) * nchroms + arrays.chrom2) * 16 + orientation) << 32
+
+def windowJoin(a, b, window, nchroms=None):
+    """
+    Returns (aidx, bidx), index arrays of all pairs of rows of pairarrays a
+    and b with the same chromosomes and orientation whose first and second
+    positions are each within window of each other
+    """
+    if nchroms is None:
+        nchroms = int(max([0] + [x.max() + 1 for x in [a.chrom1, a.chrom2, b.chrom1, b.chrom2] if len(x) > 0]))
+    if nchroms > __maxchroms__:
+        raise ValueError("Too many chromosomes to join (%d, maximum %d)" % (nchroms, __maxchroms__))
+
+    bkeys = __groupkeys__(b, nchroms) + b.pos1
+    border = np.argsort(bkeys, kind='mergesort')
+    bsorted = bkeys[border]
+    akeys = __groupkeys__(a, nchroms)
+
+    aidxs, bidxs = [], []
+    for start in range(0, len(a.pos1), __chunksize__):
+        chunk = slice(start, start + __chunksize__)
+        lo = np.searchsorted(bsorted, akeys[chunk] + np.maximum(a.pos1[chunk] - window, 0), side='left')
+        hi = np.searchsorted(bsorted, akeys[chunk] + a.pos1[chunk] + window, side='right')
+        counts = hi - lo
+        total = counts.sum()
+        if total == 0:
+            continue
+
+        # expand each row's range of candidates
+        aidx = np.repeat(np.arange(start, start + len(counts)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        bidx = border[np.repeat(lo, counts) + offsets]
+
+        close = np.abs(a.pos2[aidx] - b.pos2[bidx]) <= window
+        aidxs.append(aidx[close])
+        bidxs.append(bidx[close])
+
+    if not aidxs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(aidxs), np.concatenate(bidxs)
+
+def readPairs(filename, forceSV=False, noFilter=False, filterByChromosome=True):
+    """The breakpoint pairs of the SV records in a (possibly gzipped) VCF file"""
+    pairs = []
+    for record in vcf.Reader(partition.openVCF(filename), compressed=False):
+        if not (record.FILTER is None or len(record.FILTER) == 0 or noFilter):
+            continue
+        if filterByChromosome and not mergedfile.mapped_to_chromosome(record.CHROM):
+            continue
+        if not variantdict.isSV(record, forceSV):
+            continue
+        pairs.extend(variantdict.normalizedVariants(record, forceSV))
+    return pairs
+
+def concordance(pairlists, labels, window):
+    """
+    Pairwise concordance between callers' breakpoint pairs.  Returns a list
+    of (label1, label2, n1, n2, n1 matched in 2, n2 matched in 1,
+    number of matching pairs) for each pair of callers.
+    """
+    chromids = {}
+    arrays = [pairArrays(pairs, chromids) for pairs in pairlists]
+    nchroms = max(len(chromids), 1)
+
+    report = []
+    for i, j in itertools.combinations(range(len(arrays)), 2):
+        aidx, bidx = windowJoin(arrays[i], arrays[j], window, nchroms)
+        report.append((labels[i], labels[j], len(arrays[i].row), len(arrays[j].row),
+                       len(np.unique(aidx)), len(np.unique(bidx)), len(aidx)))
+    return report
+
+def writeConcordance(report, outfile):
+    outfile.write("#caller1\tcaller2\tcalls1\tcalls2\tcalls1_matched\tcalls2_matched\tmatching_pairs\n")
+    for row in report:
+        outfile.write("\t".join(str(field) for field in row) + "\n")
+
+def concordanceMain(argv):
+    """Entry point for mergevcf concordance"""
+    parser = argparse.ArgumentParser(prog='mergevcf concordance',
+                                     description='Report pairwise concordance of SV calls between callers')
+    parser.add_argument('input_files', nargs='+', help='Input VCF files')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help="Specify output file (default:stdout)")
+    parser.add_argument('-l', '--labels', type=str, help='Comma-separated labels for each input VCF file (default:basenames)')
+    parser.add_argument('-s', '--sv', action='store_true', help='Force interpretation as SV (default:false)')
+    parser.add_argument('-f', '--filtered', action='store_true', help='Include records that have failed one or more filters (default:false)')
+    parser.add_argument('-w', '--svwindow', default=jobs.defsvwindow, type=int,
+                         help='Window for comparing breakpoint positions for SVs (default:'+str(jobs.defsvwindow)+')')
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error("numpy is required for concordance")
+
+    if args.labels is None:
+        labels = jobs.defaultLabels(args.input_files)
+    else:
+        labels = [label.strip() for label in args.labels.split(',')]
+    pairlists = [readPairs(f, args.sv, args.filtered) for f in args.input_files]
+    writeConcordance(concordance(pairlists, labels, args.svwindow), args.output)
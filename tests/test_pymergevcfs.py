@@ -1,6 +1,51 @@
 import unittest
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
 from mergevcf.locations import *
 from mergevcf.variantdict import *
+import mergevcf.chunked as chunked
+import mergevcf.cohort as cohort
+import mergevcf.jobs as jobs
+import mergevcf.memory as memory
+import mergevcf.mergedindex as mergedindex
+import mergevcf.mergedfile as mergedfile
+import mergevcf.partition as partition
+import mergevcf.server as server
+import mergevcf.svcolumns as svcolumns
+import mergevcf.vcftobreakpoints as vcftobreakpoints
+import mergevcf.windowjoin as windowjoin
+import StringIO
+import struct
+import vcf
+import zlib
+
+vcfheader = """##fileformat=VCFv4.1
+##INFO=<ID=END,Number=1,Type=Integer,Description="End position">
+##INFO=<ID=SVTYPE,Number=1,Type=String,Description="Type of SV">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+"""
+
+vcfrecords = {'caller1': ["1\t100\t.\tA\tG\t.\tPASS\t.",
+                          "1\t200\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=1200",
+                          "2\t300\t.\tC\t<DUP>\t.\tPASS\tSVTYPE=DUP;END=2300"],
+              'caller2': ["1\t100\t.\tA\tG\t.\tPASS\t.",
+                          "1\t210\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=1190",
+                          "3\t150\t.\tAC\tA\t.\tPASS\t."]}
+
+def writeTestVCFs(directory):
+    """Write small test VCFs to directory, returning their filenames"""
+    filenames = []
+    for caller in sorted(vcfrecords):
+        filename = os.path.join(directory, caller+".vcf")
+        with open(filename, 'w') as f:
+            f.write(vcfheader + "\n".join(vcfrecords[caller]) + "\n")
+        filenames.append(filename)
+    return filenames
 
 class TestLocations(unittest.TestCase):
 
@@ -28,6 +73,51 @@ class TestLocations(unittest.TestCase):
         self.assertTrue( self.l2 in self.ld )
         self.assertTrue( self.l1 in self.ld )
 
+class TestBulkLoad(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(7)
+        rows = []
+        for i in range(400):
+            rows.append((rnd.choice(['1','2']), rnd.randint(1,2000), rnd.choice(['+','-']), rnd.choice([True,False]),
+                         rnd.choice(['1','3']), rnd.randint(1,2000), rnd.choice(['+','-']), rnd.choice([True,False]), i))
+        rows.sort(key=lambda row: (row[0], row[1]))
+        self.rows = rows
+        self.columns = [list(column) for column in zip(*rows)]
+        self.probes = [location(c, p, s, e) for c in ['1','2','3'] for p in range(0, 2100, 7)
+                       for s in ['+','-'] for e in [True, False]]
+
+    def test_locationdict(self):
+        incremental = locationdict(window=20)
+        for chrom, pos, strand, extent, _, _, _, _, payload in self.rows:
+            locn = location(chrom, pos, strand, extent)
+            if locn in incremental:
+                incremental[locn].append(payload)
+            else:
+                incremental[locn] = [payload]
+        c = self.columns
+        bulk = locationdict.fromsorted(20, c[0], c[1], c[2], c[3], c[8])
+        self.assertEqual( sorted(incremental.values()), sorted(bulk.values()) )
+        for probe in self.probes:
+            self.assertEqual( probe in incremental, probe in bulk )
+            if probe in bulk:
+                self.assertEqual( incremental[probe], bulk[probe] )
+
+    def test_locationpairdict(self):
+        incremental = locationpairdict(window=20)
+        for chrom1, pos1, strand1, extent1, chrom2, pos2, strand2, extent2, payload in self.rows:
+            incremental[(location(chrom1, pos1, strand1, extent1), location(chrom2, pos2, strand2, extent2))] = payload
+        bulk = locationpairdict.fromsorted(20, *self.columns)
+        for chrom1, pos1, strand1, extent1, chrom2, pos2, strand2, extent2, _ in self.rows:
+            for off1, off2 in [(0, 0), (-15, 5), (12, -25), (30, 0)]:
+                pair = (location(chrom1, pos1+off1, strand1, extent1), location(chrom2, pos2+off2, strand2, extent2))
+                self.assertEqual( pair in incremental, pair in bulk )
+                if pair in bulk:
+                    self.assertEqual( incremental[pair], bulk[pair] )
+
+    def test_unsorted(self):
+        self.assertRaises( ValueError, locationdict.fromsorted, 10, ['1','1'], [50, 20], ['+','+'], [False,False], ['a','b'] )
+
 class TestVariantMap(unittest.TestCase):
 
     def setUp(self):
@@ -54,5 +144,618 @@ class TestVariantMap(unittest.TestCase):
             nin += 1
         self.assertTrue( nin == 4 )
 
+    def test_smallvariants(self):
+        self.assertEqual(self.vmap[(self.l1,('A','G'))], ['sga','dkfz'])
+        self.assertEqual(self.vmap.nclusters(), 4)
+        store = smallvariantstore()
+        store.add('1', 100, ('A','G'), 'b')
+        store.add('1', 100, ('A','T'), 'a')
+        store.add('1', 100, ('A','G'), 'a')
+        store.add('2', 100, ('A','G'), 'a')
+        self.assertTrue(('1', 100, ('A','T')) in store)
+        self.assertFalse(('2', 100, ('A','T')) in store)
+        self.assertEqual(store.callers('1', 100, ('A','G')), ['b','a'])
+        self.assertEqual(list(store), [('1', 100, ('A','G'), ['b','a']),
+                                       ('1', 100, ('A','T'), ['a']),
+                                       ('2', 100, ('A','G'), ['a'])])
+
+    def test_hotspot(self):
+        vmap = variantmap(0, 40, hotspotlimit=5)
+        for i in range(100):
+            vmap.__setitem__((location('1', 1000 + i % 20), location('1', 5000)), ['a', 'b'][i % 2], i)
+        vmap[(location('2', 1000), location('2', 5000))] = 'a'
+        variants = list(vmap)
+        self.assertEqual( len(variants), 2 )
+        hotspots = [v for v in variants if isinstance(v[5], reservoir)]
+        self.assertEqual( len(hotspots), 1 )
+        loc1, loc2, callers, pos1, pos2, records = hotspots[0]
+        self.assertEqual( dict(callers), {'a': 50, 'b': 50} )
+        self.assertEqual( records.seen, 100 )
+        self.assertEqual( len(records), 5 )
+        # the positions summarized are those of the sampled records
+        self.assertEqual( pos1, sorted(1000 + i % 20 for caller, i in records)[2] )
+
+class TestPartitions(unittest.TestCase):
+
+    def test_partitionkey(self):
+        self.assertEqual( partitionKey((location('1',100), ('A','G'))), '1' )
+        self.assertEqual( partitionKey((location('1',100), location('X',500))), '1' )
+
+    def test_spillfiles(self):
+        spill = partition.spillfiles()
+        try:
+            spill.write('1', 0, "line a\n")
+            spill.write('2', 0, "line b\n")
+            spill.write('1', 0, "line c\n")
+            spill.write('1', 1, "line d\n")
+            self.assertEqual( spill.count('1'), 3 )
+            runs = [(idx, list(lines)) for idx, lines in spill.read('1')]
+            self.assertEqual( runs, [(0, ["line a\n", "line c\n"]), (1, ["line d\n"])] )
+        finally:
+            spill.cleanup()
+
+    def test_memorysize(self):
+        self.assertEqual( memory.parseMemorySize('512M'), 512*1024**2 )
+        self.assertEqual( memory.parseMemorySize('1.5gb'), int(1.5*1024**3) )
+        self.assertEqual( memory.parseMemorySize('1000'), 1000 )
+        self.assertRaises( ValueError, memory.parseMemorySize, 'lots' )
+
+    def test_spilled_merge(self):
+        tmpdir = tempfile.mkdtemp()
+        nearlyExceeded = memory.memorybudget.nearlyExceeded
+        batchsize = mergedfile.__batchsize__
+        try:
+            inputs = []
+            rnd = random.Random(5)
+            for caller in ['caller1', 'caller2']:
+                lines = ["1\t1050\t.\tA\tA[2:300[\t.\tPASS\tSVTYPE=BND", "1\t960\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=5000"]
+                if caller == 'caller2':
+                    lines = ["1\t1140\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=5000"]
+                for i in range(50):
+                    lines.append("%s\t%d\t.\tA\tA[%s:%d[\t.\tPASS\tSVTYPE=BND" % (rnd.choice('12'), rnd.randint(1, 3000),
+                                                                              rnd.choice('12'), rnd.randint(1, 3000)))
+                inputs.append(os.path.join(tmpdir, caller + '.vcf'))
+                with open(inputs[-1], 'w') as f:
+                    f.write(vcfheader + "\n".join(lines) + "\n")
+
+            def merge(**kwargs):
+                output = os.path.join(tmpdir, 'merged.vcf')
+                stats = mergedfile.merge(inputs, ['caller1', 'caller2'], False, open(output, 'w'),
+                                         slop=100, verbose=False, **kwargs)
+                return stats, sorted(open(output).readlines())
+
+            expected = merge()[1]
+            calls = [False]
+            def spillAfterFirst(budget):
+                spill = calls[-1]
+                calls.append(True)
+                return spill
+            memory.memorybudget.nearlyExceeded = spillAfterFirst
+            mergedfile.__batchsize__ = 1
+            stats, lines = merge(maxMemory=64*1024**3)
+            self.assertEqual( stats['partitions'], 2 )
+            self.assertEqual( lines, expected )
+        finally:
+            memory.memorybudget.nearlyExceeded = nearlyExceeded
+            mergedfile.__batchsize__ = batchsize
+            shutil.rmtree(tmpdir)
+
+    def test_budget_too_small(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inputs = writeTestVCFs(tmpdir)
+            with open(os.path.join(tmpdir, 'merged.vcf'), 'w') as outfile:
+                self.assertRaises( MemoryError, mergedfile.merge, inputs, ['a', 'b'], False,
+                                   outfile, verbose=False, maxMemory=memory.currentRSS()//2 )
+        finally:
+            shutil.rmtree(tmpdir)
+
+@unittest.skipIf(not svcolumns.available(), "numpy not installed")
+class TestSVColumns(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(3)
+        lines = []
+        for i in range(500):
+            pos = rnd.randint(1, 1000)
+            end = pos + rnd.randint(-2, 2) if rnd.random() < 0.3 else rnd.randint(1, 1000)
+            svtype = rnd.choice(['DEL', 'DUP', 'DUP:TANDEM', 'INV', 'INS', 'BND'])
+            info = ['END=%d' % end]
+            if rnd.random() < 0.5:
+                info.append('CT=%s' % rnd.choice(['3to5', '5to3', '5to5', '3to3']))
+            alt = '<%s>' % svtype if svtype != 'BND' else 'N[1:%d[' % end
+            lines.append("\t".join([rnd.choice(['1', 'chrX']), str(pos), '.', 'N', alt, '.', 'PASS', ';'.join(info)]))
+        header = vcfheader.replace('#CHROM', '##INFO=<ID=CT,Number=1,Type=String,Description="Connection type">\n#CHROM')
+        self.records = list(vcf.Reader(StringIO.StringIO(header + "\n".join(lines) + "\n")))
+
+    def test_matches_scalar(self):
+        batch = svcolumns.breakpointsFromRecords(self.records)
+        for record, pairs in zip(self.records, batch):
+            expected = vcftobreakpoints.breakpointsFromRecord(record)
+            self.assertEqual( [(l1.asTuple(), l2.asTuple()) for l1, l2 in pairs],
+                              [(l1.asTuple(), l2.asTuple()) for l1, l2 in expected] )
+
+    def test_fallback(self):
+        bkpts, fallback = svcolumns.symbolicBreakpoints([0, 0], [100, 100], [-1, 200],
+                                                        [svcolumns.DEL, svcolumns.INV],
+                                                        [svcolumns.CT_NONE, svcolumns.CT_NONE])
+        self.assertEqual( fallback.tolist(), [True, False] )
+        self.assertEqual( bkpts.row.tolist(), [1, 1] )
+        self.assertEqual( bkpts.pos1.tolist(), [100, 101] )
+        self.assertEqual( bkpts.pos2.tolist(), [199, 200] )
+
+@unittest.skipIf(not svcolumns.available(), "numpy not installed")
+class TestWindowJoin(unittest.TestCase):
+
+    def randomPairs(self, rnd, n):
+        pairs = []
+        for i in range(n):
+            l1 = location(rnd.choice(['1', '2']), rnd.randint(0, 2000), True, rnd.random() < 0.5)
+            l2 = location(rnd.choice(['1', '2', 'X']), rnd.randint(0, 2000), rnd.random() < 0.5, rnd.random() < 0.5)
+            pairs.append((l1, l2))
+        return pairs
+
+    def test_matches_bruteforce(self):
+        rnd = random.Random(5)
+        a, b = self.randomPairs(rnd, 400), self.randomPairs(rnd, 300)
+        window = 50
+
+        expected = set()
+        for i, (a1, a2) in enumerate(a):
+            for j, (b1, b2) in enumerate(b):
+                if a1.asTuple()[:1] + a1.asTuple()[2:] == b1.asTuple()[:1] + b1.asTuple()[2:] and \
+                   a2.asTuple()[:1] + a2.asTuple()[2:] == b2.asTuple()[:1] + b2.asTuple()[2:] and \
+                   abs(a1.pos - b1.pos) <= window and abs(a2.pos - b2.pos) <= window:
+                    expected.add((i, j))
+
+        chromids = {}
+        aidx, bidx = windowjoin.windowJoin(windowjoin.pairArrays(a, chromids),
+                                           windowjoin.pairArrays(b, chromids), window)
+        self.assertTrue( len(expected) > 0 )
+        self.assertEqual( set(zip(aidx.tolist(), bidx.tolist())), expected )
+
+    def test_readpairs(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            plain = writeTestVCFs(tmpdir)[0]
+            gzipped = plain + '.gz'
+            writeBGZF(gzipped, open(plain).read(), 100)
+            pairs = windowjoin.readPairs(plain)
+            self.assertEqual( len(pairs), 2 )
+            self.assertEqual( repr(windowjoin.readPairs(gzipped)), repr(pairs) )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_concordance(self):
+        pairs = [(location('1', 100, True, False), location('1', 500, True, True))]
+        moved = [(location('1', 120, True, False), location('1', 480, True, True))]
+        report = windowjoin.concordance([pairs, moved, []], ['a', 'b', 'c'], 50)
+        self.assertEqual( report, [('a', 'b', 1, 1, 1, 1, 1), ('a', 'c', 1, 0, 0, 0, 0),
+                                   ('b', 'c', 1, 0, 0, 0, 0)] )
+
+@unittest.skipIf(not svcolumns.available(), "numpy not installed")
+class TestMergedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.merged = os.path.join(self.tmpdir, 'merged.vcf')
+        lines = ["1\t100\t.\tA\tG\t.\t.\tCallers=a,b;NumCallers=2",
+                 "2\t702\t.\tN\tN[5:1005[\t.\t.\tCallers=a,b;SVTYPE=BND;NumCallers=2",
+                 "1\t205\t.\tN\tN[1:1195[\t.\t.\tCallers=a;END=1200;SVTYPE=DEL;SVLEN=990;NumCallers=1",
+                 "1\t5000\t.\tN\tN]1:8999]\t.\t.\tCallers=b;END=9000;SVTYPE=INV;SVLEN=3999;NumCallers=1"]
+        with open(self.merged, 'w') as outfile:
+            outfile.write(vcfheader + "\n".join(lines) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_queries(self):
+        built = mergedindex.mergedcallindex.build(self.merged)
+        built.save(os.path.join(self.tmpdir, 'index'))
+        loaded = mergedindex.mergedcallindex.load(os.path.join(self.tmpdir, 'index'))
+        for index in [built, loaded]:
+            self.assertEqual( len(index), 4 )
+            calls = lambda idx: [index.call(i)[:2] for i in idx]
+            self.assertEqual( calls(index.region('1', 1, 300)), [('1', 100), ('1', 205)] )
+            self.assertEqual( calls(index.region('1', 1, 300, callers=['b'])), [('1', 100)] )
+            self.assertEqual( calls(index.region('1', 1, 300, callers=['a'], exact=True)), [('1', 205)] )
+            self.assertEqual( calls(index.near('5', 1000, 10)), [('2', 702)] )
+            self.assertEqual( calls(index.near('5', 1000, 10, mates=False)), [] )
+            self.assertEqual( calls(index.breakpoint('5', 1010, '2', 700, 10, mincallers=2)), [('2', 702)] )
+            self.assertEqual( calls(index.breakpoint('1', 5000, '1', 9000, 10, callers=['a'])), [] )
+            self.assertEqual( index.call(index.near('1', 9000, 5)[0]), ('1', 5000, '1', 8999, ['b']) )
+            self.assertTrue( list(index.lines(index.near('1', 100, 0)))[0].startswith("1\t100\t") )
+
+class TestCheckpoint(unittest.TestCase):
+
+    class failingfile(object):
+        def write(self, text):
+            raise IOError("disk full")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.inputs = writeTestVCFs(self.tmpdir)
+        self.checkpoint = os.path.join(self.tmpdir, 'merge.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def merge(self, outfile, inputs=None, **kwargs):
+        return mergedfile.merge(inputs or self.inputs, ['caller1', 'caller2'], False, outfile,
+                                slop=100, verbose=False, **kwargs)
+
+    def test_resume(self):
+        expected = os.path.join(self.tmpdir, 'expected.vcf')
+        self.merge(open(expected, 'w'))
+
+        batchsize = mergedfile.__batchsize__
+        mergedfile.__batchsize__ = 1
+        try:
+            self.assertRaises( IOError, self.merge, self.failingfile(), checkpoint=self.checkpoint,
+                               checkpointInterval=0 )
+        finally:
+            mergedfile.__batchsize__ = batchsize
+        self.assertTrue( os.path.exists(self.checkpoint) )
+        self.assertRaises( ValueError, self.merge, StringIO.StringIO(), inputs=self.inputs[::-1],
+                           checkpoint=self.checkpoint, resume=True )
+
+        output = os.path.join(self.tmpdir, 'resumed.vcf')
+        stats = self.merge(open(output, 'w'), checkpoint=self.checkpoint, resume=True)
+        self.assertEqual( sorted(open(output).readlines()), sorted(open(expected).readlines()) )
+        self.assertEqual( stats['records'], {'caller1': 3, 'caller2': 3} )
+        self.assertFalse( os.path.exists(self.checkpoint) )
+
+    def test_error_report(self):
+        with open(self.inputs[0], 'a') as vcffile:
+            vcffile.write("1\t5000\t.\tA\t<INV>\t.\tPASS\tSVTYPE=INV\n")
+            vcffile.write("1\t6000\t.\tA\tG\t.\tPASS\t.\n")
+        stats = self.merge(StringIO.StringIO())
+        self.assertEqual( stats['errors'].keys(), ['caller1'] )
+        self.assertEqual( stats['errors']['caller1']['type'], 'TypeError' )
+        # the records before the bad one, in the same batch, are still merged
+        self.assertEqual( stats['errors']['caller1']['line'], 8 )
+        self.assertEqual( stats['records'], {'caller1': 3, 'caller2': 3} )
+
+def writeBGZF(filename, text, blocksize):
+    """Write text as BGZF blocks of blocksize uncompressed bytes, and the empty end block"""
+    with open(filename, 'wb') as f:
+        for start in range(0, len(text), blocksize) + [len(text)]:
+            data = text[start:start+blocksize]
+            deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = deflate.compress(data) + deflate.flush()
+            f.write('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H', 6) +
+                    'BC' + struct.pack('<HH', 2, len(cdata) + 25) + cdata +
+                    struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+class TestChunked(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rnd = random.Random(7)
+        lines = []
+        for i in range(300):
+            pos = rnd.randint(1, 100000)
+            if rnd.random() < 0.5:
+                lines.append("1\t%d\t.\tA\tG\t.\t%s\t." % (pos, rnd.choice(['PASS', 'PASS', 'LowQual'])))
+            else:
+                lines.append("%s\t%d\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=%d" % (rnd.choice(['1', '2']), pos, pos + rnd.randint(100, 5000)))
+        self.text = vcfheader + "\n".join(lines) + "\n"
+        self.plain = os.path.join(self.tmpdir, 'calls.vcf')
+        with open(self.plain, 'w') as f:
+            f.write(self.text)
+        self.bgzf = os.path.join(self.tmpdir, 'calls.vcf.gz')
+        writeBGZF(self.bgzf, self.text, 500)
+        # blocks of whole lines, with empty blocks between them
+        self.linebgzf = os.path.join(self.tmpdir, 'lines.vcf.gz')
+        textlines = self.text.splitlines(True)
+        with open(self.linebgzf, 'wb') as f:
+            for start in range(0, len(textlines), 3):
+                writeBGZF(self.linebgzf + '.part', ''.join(textlines[start:start+3]), 10**6)
+                f.write(open(self.linebgzf + '.part', 'rb').read())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chunks_match_sequential(self):
+        expected = [(str(r), repr(normalizedVariants(r))) for r in vcf.Reader(StringIO.StringIO(self.text))
+                    if not r.FILTER]
+        self.assertTrue( chunked.isBGZF(self.bgzf) )
+        self.assertFalse( chunked.isBGZF(self.plain) )
+        for filename in [self.plain, self.bgzf, self.linebgzf]:
+            for chunksize in [1, 700, 10**6]:
+                chunkrecords = []
+                for c, pairs, error in self.parse(filename, chunksize):
+                    self.assertEqual( error, None )
+                    chunkrecords += [(str(r), repr(v)) for r, v in pairs]
+                self.assertEqual( chunkrecords, expected )
+
+    def parse(self, filename, chunksize):
+        header = chunked.readHeader(filename)
+        for c in chunked.chunkRanges(filename, chunksize=chunksize):
+            pairs, error = chunked._parseChunk((c, header, False, False, True))
+            yield c, pairs, error
+
+    def test_parallel_merge(self):
+        outputs = []
+        chunksize = chunked.__chunksize__
+        chunked.__chunksize__ = 1000
+        try:
+            for filename, parseJobs in [(self.plain, 1), (self.plain, 2), (self.bgzf, 2)]:
+                output = os.path.join(self.tmpdir, 'merged%d.vcf' % len(outputs))
+                mergedfile.merge([filename], ['calls'], False, open(output, 'w'), slop=100,
+                                 verbose=False, parseJobs=parseJobs)
+                outputs.append(open(output).read())
+        finally:
+            chunked.__chunksize__ = chunksize
+        self.assertEqual( outputs[1], outputs[0] )
+        self.assertEqual( outputs[2], outputs[0] )
+
+class TestSortedMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rnd = random.Random(1)
+        self.inputs = []
+        for caller in ['caller1', 'caller2', 'caller3']:
+            lines = []
+            for i in range(60):
+                chrom, pos = rnd.choice(['1', '2']), rnd.randint(1, 2000)
+                kind = rnd.random()
+                if kind < 0.4:
+                    lines.append((chrom, pos, "%s\t%d\t.\tA\t%s\t.\tPASS\t." % (chrom, pos, rnd.choice('GT'))))
+                elif kind < 0.8:
+                    lines.append((chrom, pos, "%s\t%d\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=%d" % (chrom, pos, pos + rnd.randint(100, 3000))))
+                else:
+                    # breakends reported from both mates
+                    mate, matepos = rnd.choice(['1', '2']), rnd.randint(1, 2000)
+                    lines.append((chrom, pos, "%s\t%d\t.\tA\tA[%s:%d[\t.\tPASS\tSVTYPE=BND" % (chrom, pos, mate, matepos)))
+                    lines.append((mate, matepos, "%s\t%d\t.\tA\t]%s:%d]A\t.\tPASS\tSVTYPE=BND" % (mate, matepos, chrom, pos)))
+            filename = os.path.join(self.tmpdir, caller + '.vcf')
+            with open(filename, 'w') as f:
+                f.write(vcfheader + "\n".join(line for _, _, line in sorted(lines)) + "\n")
+            self.inputs.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def merge(self, **kwargs):
+        output = os.path.join(self.tmpdir, 'merged.vcf')
+        stats = mergedfile.merge(self.inputs, ['caller1', 'caller2', 'caller3'][:len(self.inputs)], False, open(output, 'w'),
+                                 slop=100, verbose=False, min_num_callers=2, **kwargs)
+        return stats, sorted(line for line in open(output) if not line.startswith('#'))
+
+    def test_pass_only(self):
+        stats, lines = self.merge()
+        passed = [line for line in lines if line.split('\t')[6] == '.']
+        stats, passonly = self.merge(passOnly=True)
+        self.assertEqual( passonly, passed )
+        self.assertEqual( stats['dropped'], len(lines) - len(passed) )
+        self.assertEqual( stats['lowsupport'], 0 )
+
+    def test_pass_only_unmapped(self):
+        filename = os.path.join(self.tmpdir, 'unmapped.vcf')
+        with open(filename, 'w') as vcffile:
+            vcffile.write(vcfheader + "1\t100\t.\tA\tG\t.\tPASS\t.\n"
+                          "1\t500\t.\tA\tA[GL000192.1:1000[\t.\tPASS\tSVTYPE=BND\n")
+        output = os.path.join(self.tmpdir, 'merged.vcf')
+        stats = mergedfile.merge([filename], ['caller1'], False, open(output, 'w'), slop=100,
+                                 verbose=False, min_num_callers=1, passOnly=True)
+        self.assertEqual( stats['variants'], 1 )
+        self.assertEqual( stats['dropped'], 0 )
+        self.assertEqual( stats['skipped'], 1 )
+
+    def test_numcallers(self):
+        # two records from one caller and one from another make one call by two callers
+        self.inputs = []
+        for caller, positions in [('caller1', [1000, 1010]), ('caller2', [1005])]:
+            filename = os.path.join(self.tmpdir, caller + '.vcf')
+            with open(filename, 'w') as vcffile:
+                vcffile.write(vcfheader + "".join("1\t%d\t.\tA\t<DEL>\t.\tPASS\tSVTYPE=DEL;END=%d\n" % (pos, pos + 2000)
+                                                  for pos in positions))
+            self.inputs.append(filename)
+        stats, lines = self.merge(output_ncallers=True)
+        self.assertEqual( len(lines), 1 )
+        self.assertIn( ";NumCallers=2", lines[0] )
+
+    def test_streaming(self):
+        batchsize = mergedfile.__batchsize__
+        mergedfile.__batchsize__ = 10
+        try:
+            for passOnly in [False, True]:
+                expected = self.merge(passOnly=passOnly)
+                self.assertEqual( self.merge(passOnly=passOnly, sortedInputs=True), expected )
+        finally:
+            mergedfile.__batchsize__ = batchsize
+
+    def test_mates_behind(self):
+        snvs = ["%s\t%d\t.\tA\tG\t.\tPASS\t." % (chrom, pos)
+                for chrom, first in [('1', 1500), ('2', 100)] for pos in range(first, 6000, 250)]
+        calls = [["1\t1000\t.\tA\tA[2:5000[\t.\tPASS\tSVTYPE=BND",
+                  "2\t3000\t.\tA\t]1:2000]A\t.\tPASS\tSVTYPE=BND"],
+                 ["2\t5010\t.\tA\t]1:1005]A\t.\tPASS\tSVTYPE=BND",
+                  "2\t3020\t.\tA\t]1:2010]A\t.\tPASS\tSVTYPE=BND"]]
+        self.inputs = [os.path.join(self.tmpdir, 'a.vcf'), os.path.join(self.tmpdir, 'b.vcf')]
+        for filename, records in zip(self.inputs, calls):
+            key = lambda line: (line.split('\t')[0], int(line.split('\t')[1]))
+            with open(filename, 'w') as vcffile:
+                vcffile.write(vcfheader + "\n".join(sorted(records + snvs, key=key)) + "\n")
+        batchsize = mergedfile.__batchsize__
+        mergedfile.__batchsize__ = 1
+        try:
+            stats, lines = self.merge(sortedInputs=True)
+        finally:
+            mergedfile.__batchsize__ = batchsize
+        self.assertEqual( lines, self.merge()[1] )
+        breakends = [line.split('\t') for line in lines if 'SVTYPE=BND' in line]
+        self.assertEqual( [(bnd[0], bnd[1], bnd[6]) for bnd in breakends], [('1', '1002', '.'), ('1', '2005', '.')] )
+
+    def test_unsorted(self):
+        with open(self.inputs[0], 'a') as vcffile:
+            vcffile.write("1\t5\t.\tA\tG\t.\tPASS\t.\n")
+        self.assertRaises( ValueError, self.merge, sortedInputs=True )
+
+    def test_contig_order(self):
+        self.inputs = [os.path.join(self.tmpdir, 'a.vcf'), os.path.join(self.tmpdir, 'b.vcf')]
+        for filename, chroms in zip(self.inputs, [['1', '3', '10', 'X'], ['1', '2', '3', '10', 'X']]):
+            with open(filename, 'w') as vcffile:
+                vcffile.write(vcfheader + "".join("%s\t100\t.\tA\tG\t.\tPASS\t.\n" % chrom for chrom in chroms))
+        stats, lines = self.merge(sortedInputs=True)
+        self.assertEqual( len(lines), 5 )
+
+        headers = vcfheader.replace("#CHROM", "##contig=<ID=X>\n##contig=<ID=1>\n#CHROM")
+        gzipped = self.inputs[0] + '.gz'
+        writeBGZF(gzipped, headers + "X\t100\t.\tA\tG\t.\tPASS\t.\n1\t100\t.\tA\tG\t.\tPASS\t.\n", 100)
+        self.inputs = [gzipped]
+        stats, lines = self.merge(sortedInputs=True)
+        self.assertEqual( len(lines), 2 )
+
+class TestCohort(unittest.TestCase):
+
+    def test_parse_roundtrip(self):
+        pairs = [(location('1', 100, True, False), location('1', 500, True, True)),
+                 (location('1', 100, True, True), location('3', 500, True, False)),
+                 (location('2', 100, True, False), location('5', 500, False, False)),
+                 (location('2', 100, True, True), location('5', 500, False, True))]
+        for loc1, loc2 in pairs:
+            ref, alt = mergedfile.bkptRefAltFromPair(loc1, loc2)
+            line = "\t".join([loc1.chrom, str(loc1.pos), '.', ref, alt, '.', '.', 'Callers=a'])
+            chrom, variants = cohort.parseSite(line)
+            self.assertEqual( [(l1.asTuple(), l2.asTuple()) for l1, l2 in variants],
+                              [(loc1.asTuple(), loc2.asTuple())] )
+        chrom, variants = cohort.parseSite("1\t100\t.\tA\tG\t.\t.\tCallers=a")
+        self.assertEqual( variants, [(location('1', 100), ('A', 'G'))] )
+
+    def test_looseends(self):
+        catalogue = cohort.sitecatalogue(10)
+        for sample, line in enumerate(["1\t100\t.\tA\tA.\t.\t.\tCallers=a", "1\t106\t.\tC\tC.\t.\t.\tCallers=a",
+                                       "1\t104\t.\tA\t.A\t.\t.\tCallers=a"]):
+            chrom, variants = cohort.parseSite(line)
+            self.assertEqual( variants[0][1].chrom, 'None' )
+            catalogue.add(sample, variants[0])
+        output = StringIO.StringIO()
+        self.assertEqual( cohort.writeSites(catalogue, output), 2 )
+        self.assertEqual( [line.split('\t')[1:5] + line.split('\t')[7:] for line in output.getvalue().splitlines()],
+                          [['103', '.', 'N', 'N.', 'NumSamples=2;Samples=0-1'], ['104', '.', 'N', '.N', 'NumSamples=1;Samples=2']] )
+
+    def test_catalogue(self):
+        catalogue = cohort.sitecatalogue(10)
+        pair = (location('1', 100, True, False), location('1', 500, True, True))
+        near = (location('1', 105, True, False), location('1', 495, True, True))
+        samples = [0, 1, 2, 5, 200, 70000]
+        for sample in samples:
+            catalogue.add(sample, pair)
+            catalogue.add(sample, near)
+        catalogue.add(70000, (location('1', 100), ('A', 'G')))
+        self.assertEqual( len(catalogue), 2 )
+        sites = list(catalogue.sites())
+        self.assertEqual( [(pos, matepos) for site, l1, l2, pos, matepos in sites], [(100, None), (102, 497)] )
+        self.assertEqual( catalogue.samples(sites[1][0]), samples )
+        self.assertEqual( cohort.rangeString(catalogue.samples(sites[1][0])), "0-2,5,200,70000" )
+        self.assertRaises( ValueError, catalogue.add, 3, pair )
+
+    def test_cohort_merge(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writeTestVCFs(tmpdir)
+            samples = []
+            for i in range(3):
+                sample = os.path.join(tmpdir, 'sample%d.vcf' % i)
+                mergedfile.merge([os.path.join(tmpdir, 'caller%d.vcf' % c) for c in [1, 2][:i+1]],
+                                 ['caller1', 'caller2'][:i+1], False, open(sample, 'w'), verbose=False)
+                samples.append(sample)
+
+            outputs = []
+            for maxMemory in [None, int(memory.currentRSS() * 1.2)]:
+                output = StringIO.StringIO()
+                stats = cohort.cohortMerge(samples, ['a', 'b', 'c'], output, maxMemory=maxMemory)
+                outputs.append(output.getvalue())
+            self.assertEqual( outputs[0], outputs[1] )
+            self.assertTrue( 'partitions' in stats )
+            records = list(vcf.Reader(StringIO.StringIO(outputs[0])))
+            self.assertEqual( len(records), stats['sites'] )
+            self.assertTrue( all(record.INFO['NumSamples'] >= 1 for record in records) )
+            self.assertTrue( "##sample=<Index=2,ID=c>" in outputs[0] )
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.inputs = writeTestVCFs(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def job(self, output):
+        return {'inputs': self.inputs, 'output': os.path.join(self.tmpdir, output),
+                'options': {'mincallers': 2}}
+
+    def test_runjob(self):
+        stats = jobs.runJob(self.job('merged.vcf'))
+        self.assertEqual( stats['records'], {'caller1': 3, 'caller2': 3} )
+        self.assertEqual( stats['variants'], 4 )
+        self.assertEqual( stats['lowsupport'], 2 )
+
+    def test_progress(self):
+        job = self.job('merged.vcf')
+        progressfile = os.path.join(self.tmpdir, 'progress.jsonl')
+        job['options']['progress'] = progressfile
+        jobs.runJob(job)
+        with open(progressfile) as f:
+            reports = [json.loads(line) for line in f]
+        self.assertEqual( reports[-1]['phase'], 'output' )
+        self.assertEqual( reports[-1]['clusters'], 4 )
+        inputreports = [r for r in reports if 'input' in r]
+        self.assertEqual( inputreports[-1]['input'], 'caller2' )
+        self.assertEqual( inputreports[-1]['records'], 3 )
+        self.assertEqual( inputreports[-1]['fraction'], 1.0 )
+
+    def test_server(self):
+        socketpath = os.path.join(self.tmpdir, 'mergevcf.sock')
+        mergeserver = server.mergeserver(socketpath, 1)
+        thread = threading.Thread(target=mergeserver.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual( server.submit({'command': 'ping'}, socketpath)['status'], 'ok' )
+            self.assertEqual( os.stat(socketpath).st_mode & 0o777, 0o600 )
+            self.assertRaises( socket.error, server.mergeserver, socketpath, 1 )
+            stats = server.submitOrRun(self.job('served.vcf'), socketpath)
+            self.assertEqual( stats['variants'], 4 )
+            reply = server.submit({'inputs': ['nonexistent.vcf'], 'output': 'x.vcf'}, socketpath)
+            self.assertEqual( reply['status'], 'error' )
+        finally:
+            mergeserver.shutdown()
+            thread.join()
+            mergeserver.server_close()
+        self.assertFalse( os.path.exists(socketpath) )
+
+        stats = server.submitOrRun(self.job('unserved.vcf'), socketpath)
+        self.assertEqual( stats['variants'], 4 )
+
+    def test_server_refuses_file(self):
+        self.assertRaises( socket.error, server.mergeserver, self.inputs[0], 1 )
+        self.assertTrue( os.path.exists(self.inputs[0]) )
+        self.assertRaises( socket.error, server.mergeserver, os.path.join(self.tmpdir, 'missing', 'x.sock'), 1 )
+
+    def test_manifest(self):
+        manifestname = os.path.join(self.tmpdir, 'manifest.tsv')
+        with open(manifestname, 'w') as manifest:
+            manifest.write("# output\tinputs\tlabels\tmemory\n")
+            manifest.write("both.vcf\tcaller1.vcf,caller2.vcf\ta,b\t2G\n")
+            manifest.write("one.vcf\tcaller1.vcf\n")
+        with open(manifestname) as manifest:
+            joblist = jobs.readManifest(manifest)
+        self.assertEqual( len(joblist), 2 )
+        self.assertEqual( joblist[0]['labels'], ['a', 'b'] )
+        self.assertEqual( joblist[0]['maxmemory'], 2*1024**3 )
+        self.assertEqual( joblist[1]['inputs'], [self.inputs[0]] )
+
+        results = jobs.runManifest(joblist, {'mincallers': 2}, nworkers=2)
+        self.assertEqual( [r['status'] for r in results], ['ok', 'ok'] )
+        self.assertEqual( results[0]['lowsupport'], 2 )
+        results = jobs.runManifest(joblist, {'mincallers': 2}, nworkers=2)
+        self.assertEqual( [r['status'] for r in results], ['skipped', 'skipped'] )
+
 if __name__ == '__main__':
     unittest.main()